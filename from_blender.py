@@ -4,6 +4,8 @@
 
 # Some classes and constants from libsm64-blender
 import ctypes as ct
+import hashlib
+import mmap
 import os
 
 SM64_TEXTURE_WIDTH = 64 * 11
@@ -11,31 +13,56 @@ SM64_TEXTURE_HEIGHT = 64
 SM64_GEO_MAX_TRIANGLES = 1024
 SM64_SCALE_FACTOR = 50
 
-def make_image(img, buffer):
-    i = 0
-    for y in range(SM64_TEXTURE_HEIGHT):
-        for x in range(SM64_TEXTURE_WIDTH):
-            r = float(buffer[i]) / 255
-            g = float(buffer[i+1]) / 255
-            b = float(buffer[i+2]) / 255
-            a = float(buffer[i+3]) / 255
-            i += 4
-            img.setXelA(x, y, r, g, b, a)
+# Reorders the RGBA atlas into the BGRA layout Panda keeps texture RAM images in,
+# as four strided bulk copies instead of one call per texel.
+# Rows are left in buffer order, which Panda reads bottom-up
+def make_image(buffer):
+    src = memoryview(buffer).cast('B')
+    img = bytearray(len(src))
+    img[0::4] = src[2::4]
+    img[1::4] = src[1::4]
+    img[2::4] = src[0::4]
+    img[3::4] = src[3::4]
+    return bytes(img)
 
-def init_sm64(ref,  dll_dir, rom_dir):
-    ref.sm64 = ct.cdll.LoadLibrary(dll_dir)
+# libraries loaded so far by path, their prototypes are only bound the first time
+SM64_LIBRARIES = {}
+
+# Loads libsm64 and binds its function prototypes, once per library path
+def load_library(dll_dir):
+    sm64 = SM64_LIBRARIES.get(dll_dir)
+    if sm64 != None:
+        return sm64
+    sm64 = ct.cdll.LoadLibrary(dll_dir)
+
+    sm64.sm64_global_init.argtypes = [ ct.c_char_p, ct.POINTER(ct.c_ubyte), ct.c_char_p ]
+    sm64.sm64_static_surfaces_load.argtypes = [ ct.POINTER(SM64Surface), ct.c_uint32 ]
+    sm64.sm64_mario_create.argtypes = [ ct.c_int16, ct.c_int16, ct.c_int16 ]
+    sm64.sm64_mario_create.restype = ct.c_int32
+    sm64.sm64_mario_delete.argtypes = [ ct.c_int32 ]
+    sm64.sm64_mario_tick.argtypes = [ ct.c_uint32, ct.POINTER(SM64MarioInputs), ct.POINTER(SM64MarioState), ct.POINTER(SM64MarioGeometryBuffers) ]
+    # moving platforms, left unbound for builds that predate them
+    if hasattr(sm64, 'sm64_surface_object_create'):
+        sm64.sm64_surface_object_create.argtypes = [ ct.POINTER(SM64SurfaceObject) ]
+        sm64.sm64_surface_object_create.restype = ct.c_uint32
+        sm64.sm64_surface_object_move.argtypes = [ ct.c_uint32, ct.POINTER(SM64ObjectTransform) ]
+        sm64.sm64_surface_object_delete.argtypes = [ ct.c_uint32 ]
 
-    ref.sm64.sm64_global_init.argtypes = [ ct.c_char_p, ct.POINTER(ct.c_ubyte), ct.c_char_p ]
-    ref.sm64.sm64_static_surfaces_load.argtypes = [ ct.POINTER(SM64Surface), ct.c_uint32 ]
-    ref.sm64.sm64_mario_create.argtypes = [ ct.c_int16, ct.c_int16, ct.c_int16 ]
-    ref.sm64.sm64_mario_create.restype = ct.c_int32
-    ref.sm64.sm64_mario_tick.argtypes = [ ct.c_uint32, ct.POINTER(SM64MarioInputs), ct.POINTER(SM64MarioState), ct.POINTER(SM64MarioGeometryBuffers) ]
+    SM64_LIBRARIES[dll_dir] = sm64
+    return sm64
 
-    with open(os.path.expanduser(rom_dir), 'rb') as file:
-        rom_bytes = bytearray(file.read())
-        rom_chars = ct.c_char * len(rom_bytes)
+def init_sm64(ref,  dll_dir, rom_dir):
+    ref.sm64 = load_library(dll_dir)
+
+    # the ROM is mapped rather than read in; copy-on-write because ctypes wants a writable
+    # buffer, though libsm64 only reads it, so nothing is ever actually copied
+    with open(os.path.expanduser(rom_dir), 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY) as rom:
+        ref.rom_hash = hashlib.sha1(rom).hexdigest()
+        rom_chars = (ct.c_char * len(rom)).from_buffer(rom)
         texture_buff = (ct.c_ubyte * (4 * SM64_TEXTURE_WIDTH * SM64_TEXTURE_HEIGHT))()
-        ref.sm64.sm64_global_init(rom_chars.from_buffer(rom_bytes), texture_buff, None)
+        ref.sm64.sm64_global_init(rom_chars, texture_buff, None)
+        # the mapping can't close while ctypes still points into it
+        del rom_chars
 
     return texture_buff
 
@@ -87,6 +114,20 @@ class SM64MarioGeometryBuffers(ct.Structure):
     def __del__(self):
         pass
 
+# position in libsm64 units, rotation in degrees, applied Z then X then Y like the game does
+class SM64ObjectTransform(ct.Structure):
+    _fields_ = [
+        ('position', ct.c_float * 3),
+        ('eulerRotation', ct.c_float * 3)
+    ]
+
+class SM64SurfaceObject(ct.Structure):
+    _fields_ = [
+        ('transform', SM64ObjectTransform),
+        ('surfaceCount', ct.c_uint32),
+        ('surfaces', ct.POINTER(SM64Surface))
+    ]
+
 COLLISION_TYPES = {
     "SURFACE_DEFAULT": 0x0000,
     "SURFACE_BURNING": 0x0001,
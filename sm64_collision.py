@@ -0,0 +1,223 @@
+import hashlib
+import math
+import os
+import numpy as np
+from panda3d.core import *
+from from_blender import *
+from sm64_surfaces import *
+
+# Collision compilation for libsm64-panda
+# Panda geometry is read, transformed and quantized into SM64Surface arrays in bulk
+
+# panda world space (Z up) to libsm64 space (Y up, scaled up)
+PANDA_TO_SM64 = Mat4.convertMat(CS_zup_right, CS_yup_right) * Mat4.scaleMat(SM64_SCALE_FACTOR)
+
+# the same axis change on its own, for rotations
+ZUP_TO_YUP = Mat3.convertMat(CS_zup_right, CS_yup_right)
+YUP_TO_ZUP = Mat3.convertMat(CS_yup_right, CS_zup_right)
+
+# bump whenever compile_surfaces would produce different output for the same input,
+# so stale surface caches stop matching
+SURFACE_CACHE_VERSION = 1
+
+# model files precompile_surface_cache picks up
+MODEL_EXTENSIONS = ('.egg', '.egg.pz', '.bam', '.bam.pz', '.gltf', '.glb', '.obj')
+
+INDEX_DTYPES = {
+    Geom.NT_uint8: np.uint8,
+    Geom.NT_uint16: np.uint16,
+    Geom.NT_uint32: np.uint32,
+}
+
+# Reads every triangle of a geom as a (n, 3, 3) float array, transformed by mat
+def read_geom_triangles(geom, mat):
+    # converting and transforming a copy of the vertex data happens natively
+    vdata = GeomVertexData(geom.getVertexData().convertTo(GeomVertexFormat.getV3()))
+    vdata.transformVertices(mat)
+    verts = np.frombuffer(vdata.getArray(0), np.float32).reshape(-1, 3)
+
+    indices = []
+    for i in range(geom.getNumPrimitives()):
+        prim = geom.getPrimitive(i).decompose()
+        if prim.getPrimitiveType() != Geom.PT_polygons:
+            continue
+        if prim.isIndexed():
+            indices.append(np.frombuffer(prim.getVertices(), INDEX_DTYPES[prim.getIndexType()]))
+        else:
+            first = prim.getFirstVertex()
+            indices.append(np.arange(first, first + prim.getNumVertices()))
+
+    if len(indices) == 0:
+        return np.zeros((0, 3, 3), np.float32)
+    return verts[np.concatenate(indices)].reshape(-1, 3, 3)
+
+# Looks up a COLLISION_TYPES name set as a tag on the node (or its parents), if any
+def tagged_collision_type(nodePath, tag, default):
+    name = nodePath.getNetTag(tag)
+    if name == '':
+        return default
+    return COLLISION_TYPES[name]
+
+# Compiles the geometry under the given NodePaths into a surface array
+# Each GeomNode's full net transform is applied, so rotations and parents are respected,
+# relative to the origin TransformState when one is given instead of world space.
+# Surface and terrain types can be overridden per node with the "sm64_surftype" and
+# "sm64_terrain" tags, set to COLLISION_TYPES names
+def compile_surfaces(models, surftype=COLLISION_TYPES['SURFACE_DEFAULT'], terrain=COLLISION_TYPES['TERRAIN_GRASS'], origin=None):
+    groups = []
+    for model in models:
+        for nodePath in model.findAllMatches('**/+GeomNode'):
+            transform = nodePath.getNetTransform()
+            if origin != None:
+                transform = origin.invertCompose(transform)
+            mat = transform.getMat() * PANDA_TO_SM64
+            # mirrored transforms flip the winding, which flips the surface normal
+            mirrored = mat.getUpper3().determinant() < 0
+
+            geomNode = nodePath.node()
+            for i in range(geomNode.getNumGeoms()):
+                tris = read_geom_triangles(geomNode.getGeom(i), mat)
+                if mirrored:
+                    tris = tris[:, ::-1]
+                groups.append((tris,
+                               tagged_collision_type(nodePath, 'sm64_surftype', surftype),
+                               tagged_collision_type(nodePath, 'sm64_terrain', terrain)))
+
+    surfaces = make_surface_array(sum(len(tris) for tris, _, _ in groups))
+    start = 0
+    for tris, group_surftype, group_terrain in groups:
+        end = start + len(tris)
+        surfaces['surftype'][start:end] = group_surftype
+        surfaces['terrain'][start:end] = group_terrain
+        # clamp to bounds, "inspired" by libsm64-blender
+        surfaces['vertices'][start:end] = np.clip(np.rint(tris), -SM64_BOUNDS, SM64_BOUNDS)
+        start = end
+
+    return surfaces
+
+# Builds the surface cache key for a model loaded from a file, or None if it wasn't
+# Covers the file's identity, the model's net transform and the type mapping
+def surface_cache_key(model, surftype, terrain):
+    root = model.node()
+    if not isinstance(root, ModelRoot):
+        return None
+    path = os.path.abspath(root.getFullpath().toOsSpecific())
+    # panda drops the .pz from compressed models' paths when loading them by their plain name
+    if not os.path.exists(path) and os.path.exists(path + '.pz'):
+        path += '.pz'
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    mat = model.getNetTransform().getMat()
+    key = hashlib.sha1()
+    key.update(repr((SURFACE_CACHE_VERSION, SM64_SCALE_FACTOR, SM64_SURFACE_DTYPE.descr,
+                     path, stat.st_mtime_ns, stat.st_size, surftype, terrain)).encode())
+    key.update(np.array([mat.getRow(i) for i in range(4)], np.float32).tobytes())
+    return key.hexdigest()
+
+# Same as compile_surfaces, but each model loaded from a file goes through the on-disk
+# cache in cache_dir. A single cache hit is handed back memory-mapped as-is
+def compile_surfaces_cached(models, cache_dir, surftype=COLLISION_TYPES['SURFACE_DEFAULT'], terrain=COLLISION_TYPES['TERRAIN_GRASS']):
+    parts = []
+    for model in models:
+        key = surface_cache_key(model, surftype, terrain)
+        if key == None:
+            parts.append(compile_surfaces([model], surftype, terrain))
+            continue
+
+        path = os.path.join(cache_dir, f"surfaces-{key}.npy")
+        surfaces = load_surface_cache(path)
+        if surfaces is None:
+            surfaces = compile_surfaces([model], surftype, terrain)
+            save_surface_cache(surfaces, path)
+        parts.append(surfaces)
+
+    if len(parts) == 1:
+        return parts[0]
+    if len(parts) == 0:
+        return make_surface_array(0)
+    return np.concatenate(parts)
+
+# Compiles and caches every model file under asset_dir ahead of time, returning how many were cached
+# Models are compiled as loaded (identity transform), so they hit the cache at runtime
+# when added to the world without a transform of their own, which is how levels usually are
+def precompile_surface_cache(asset_dir, cache_dir, surftype=COLLISION_TYPES['SURFACE_DEFAULT'], terrain=COLLISION_TYPES['TERRAIN_GRASS']):
+    loader = Loader.getGlobalPtr()
+    count = 0
+    for dirpath, _, filenames in os.walk(asset_dir):
+        for filename in filenames:
+            if not filename.lower().endswith(MODEL_EXTENSIONS):
+                continue
+            node = loader.loadSync(Filename.fromOsSpecific(os.path.join(dirpath, filename)))
+            if node == None:
+                print("Couldn't load " + filename + " for the surface cache")
+                continue
+            compile_surfaces_cached([NodePath(node)], cache_dir, surftype, terrain)
+            count += 1
+    return count
+
+# Converts a panda net transform into a libsm64 object transform, scale left out
+# The euler angles undo libsm64's Z then X then Y rotation matrix
+def object_transform(transform):
+    rot = Mat3()
+    transform.getQuat().extractToMatrix(rot)
+    rot = YUP_TO_ZUP * rot * ZUP_TO_YUP
+
+    result = SM64ObjectTransform()
+    result.position[:] = list(PANDA_TO_SM64.xformPoint(transform.getPos()))
+    result.eulerRotation[:] = [
+        math.degrees(math.asin(max(-1.0, min(1.0, -rot.getCell(2, 1))))),
+        math.degrees(math.atan2(rot.getCell(2, 0), rot.getCell(2, 2))),
+        math.degrees(math.atan2(rot.getCell(0, 1), rot.getCell(1, 1))),
+    ]
+    return result
+
+# A NodePath libsm64 collides with as a moving surface object, see SM64State.add_collider
+# Its triangles are compiled in its own space with its scale baked in, after which only its
+# position and rotation are sent over. A change of scale means compiling it again
+class SM64Collider:
+    def __init__(self, state, nodePath, surftype=COLLISION_TYPES['SURFACE_DEFAULT'], terrain=COLLISION_TYPES['TERRAIN_GRASS'], dynamic=True):
+        self.state = state
+        self.nodePath = nodePath
+        self.surftype = surftype
+        self.terrain = terrain
+        self.dynamic = dynamic
+        self.compile(nodePath.getNetTransform())
+        # set once it's created natively
+        self.object_id = None
+
+    # Compiles the NodePath's triangles with the given net transform's scale and shear baked in
+    def compile(self, transform):
+        self.transform = transform
+        self.compiled_transform = transform
+        origin = TransformState.makePosQuatScale(transform.getPos(), transform.getQuat(), Vec3(1, 1, 1))
+        self.surfaces = compile_surfaces([self.nodePath], self.surftype, self.terrain, origin)
+
+    # Creates the surface object where the NodePath is now
+    def create(self, state):
+        self.transform = self.nodePath.getNetTransform()
+        self.object_id = state.create_surface_object(self.surfaces, object_transform(self.transform))
+
+    # Has a static collider synced on the next tick, after its NodePath was moved
+    def mark_moved(self):
+        if not self.dynamic and self.object_id != None and self not in self.state.moved_colliders:
+            self.state.moved_colliders.append(self)
+
+    # Sends the NodePath's transform to libsm64 if it changed since last time, returns whether it did
+    # transform states are cached and shared, so an unchanged one compares equal by pointer
+    def sync(self, state):
+        transform = self.nodePath.getNetTransform()
+        if transform == self.transform:
+            return False
+        self.transform = transform
+        if not (transform.getScale().almostEqual(self.compiled_transform.getScale()) and
+                transform.getShear().almostEqual(self.compiled_transform.getShear())):
+            # libsm64 objects can only move and turn, so a rescaled one is replaced
+            state.delete_surface_object(self.object_id)
+            self.compile(transform)
+            self.create(state)
+            return True
+        state.move_surface_object(self.object_id, object_transform(transform))
+        return True
@@ -0,0 +1,175 @@
+import ctypes as ct
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+from from_blender import *
+from sm64_sim import *
+from sm64_surfaces import *
+
+# Multi-process simulation farm for libsm64-panda
+# libsm64 keeps its world in process-global state, so each world gets its own worker process.
+# Inputs and states live in shared memory laid out exactly like SM64MarioInputs/SM64MarioState,
+# workers tick straight out of and into it, and stepping only passes through a pair of barriers
+
+# worker commands
+FARM_STEP = 0
+FARM_RESET = 1
+FARM_STOP = 2
+
+# Worker process entry point, runs one world until told to stop
+def farm_worker(world, marios_per_world, dll_directory, dll_name_stub, rom_path, surfaces, spawns,
+                memory_names, command, ticks, start_barrier, done_barrier):
+    blocks = [shared_memory.SharedMemory(name=name) for name in memory_names]
+    try:
+        run_farm_world(world, marios_per_world, dll_directory, dll_name_stub, rom_path, surfaces, spawns,
+                       blocks, command, ticks, start_barrier, done_barrier)
+    except:
+        # let the farm (and the other workers) fail instead of waiting forever
+        start_barrier.abort()
+        done_barrier.abort()
+        raise
+    for block in blocks:
+        block.close()
+
+# Body of farm_worker, everything pointing into the shared blocks is gone once this returns
+def run_farm_world(world, marios_per_world, dll_directory, dll_name_stub, rom_path, surfaces, spawns,
+                   blocks, command, ticks, start_barrier, done_barrier):
+    first = world * marios_per_world
+    inputs = (SM64MarioInputs * marios_per_world).from_buffer(blocks[0].buf, first * ct.sizeof(SM64MarioInputs))
+    states = (SM64MarioState * marios_per_world).from_buffer(blocks[1].buf, first * ct.sizeof(SM64MarioState))
+    alive = (ct.c_ubyte * marios_per_world).from_buffer(blocks[2].buf, first)
+
+    state = SM64SimState(dll_directory, dll_name_stub, rom_path)
+    if isinstance(surfaces, str):
+        surfaces = load_surface_cache(surfaces)
+    state.load_static_surfaces(surfaces)
+    # room for every Mario up front, so the state's slot arrays never grow
+    # and rebind Marios away from the shared slots
+    if marios_per_world > len(state.slot_marios):
+        state.grow_slots(marios_per_world)
+
+    # creates this world's Marios, without geometry
+    def spawn():
+        marios = []
+        for i in range(marios_per_world):
+            x, y, z = spawns[i]
+            mario = SM64SimMario(state, x, y, z, geometry=False)
+            if mario.mario_id == -1:
+                alive[i] = 0
+                continue
+            # ticks read and write the shared slots directly
+            mario.use_buffers(inputs[i], states[i])
+            mario.farm_slot = i
+            marios.append(mario)
+            alive[i] = 1
+        return marios
+
+    marios = spawn()
+    done_barrier.wait()
+
+    while True:
+        start_barrier.wait()
+        if command.value == FARM_STOP:
+            break
+        if command.value == FARM_RESET:
+            for mario in marios:
+                mario.delete()
+            # the last run's states would otherwise linger until the next step
+            ct.memset(states, 0, ct.sizeof(states))
+            marios = spawn()
+        else:
+            for mario in state.run_sim_ticks(marios, ticks.value):
+                alive[mario.farm_slot] = 0
+                state.remove_mario(mario)
+                marios.remove(mario)
+        done_barrier.wait()
+
+    for mario in marios:
+        mario.delete()
+
+class SM64Farm:
+    # Starts num_worlds worker processes, each with its own SM64SimState and marios_per_world Marios
+    # surfaces is a surface array (see sm64_surfaces) or the path of a cached one,
+    # spawns holds an (x, y, z) spawn point per Mario, the same in every world.
+    # inputs, states and alive are (num_worlds, marios_per_world) views of the shared memory
+    def __init__(self, num_worlds, marios_per_world, dll_directory: str, dll_name_stub: str, rom_path: str,
+                 surfaces, spawns, timeout=None):
+        self.num_worlds = num_worlds
+        self.marios_per_world = marios_per_world
+        self.timeout = timeout
+        count = num_worlds * marios_per_world
+
+        self.blocks = [
+            shared_memory.SharedMemory(create=True, size=count * SM64_INPUTS_DTYPE.itemsize),
+            shared_memory.SharedMemory(create=True, size=count * SM64_STATE_DTYPE.itemsize),
+            shared_memory.SharedMemory(create=True, size=count),
+        ]
+        self.inputs = np.ndarray((num_worlds, marios_per_world), SM64_INPUTS_DTYPE, self.blocks[0].buf)
+        self.states = np.ndarray((num_worlds, marios_per_world), SM64_STATE_DTYPE, self.blocks[1].buf)
+        self.alive = np.ndarray((num_worlds, marios_per_world), np.uint8, self.blocks[2].buf)
+
+        # spawn, not fork, so no worker inherits anything libsm64-related from this process
+        context = multiprocessing.get_context('spawn')
+        self.command = context.RawValue(ct.c_int, FARM_STEP)
+        self.ticks = context.RawValue(ct.c_int, 0)
+        self.start_barrier = context.Barrier(num_worlds + 1)
+        self.done_barrier = context.Barrier(num_worlds + 1)
+
+        memory_names = [block.name for block in self.blocks]
+        spawns = [tuple(spawn) for spawn in spawns]
+        self.workers = []
+        try:
+            for world in range(num_worlds):
+                worker = context.Process(target=farm_worker, name='SM64FarmWorld' + str(world), daemon=True, args=(
+                    world, marios_per_world, dll_directory, dll_name_stub, rom_path, surfaces, spawns,
+                    memory_names, self.command, self.ticks, self.start_barrier, self.done_barrier))
+                worker.start()
+                self.workers.append(worker)
+
+            # wait for every world to be set up
+            self.done_barrier.wait(self.timeout)
+        except:
+            # a world failed to set up (or timed out), don't leave the others or the shared memory behind
+            for worker in self.workers:
+                worker.terminate()
+            for worker in self.workers:
+                worker.join()
+            self.workers = None
+            self.free_memory()
+            raise
+
+    def run_command(self, command, ticks=0):
+        self.command.value = command
+        self.ticks.value = ticks
+        self.start_barrier.wait(self.timeout)
+        if command != FARM_STOP:
+            self.done_barrier.wait(self.timeout)
+
+    # Steps every world by the given number of ticks using the current contents of inputs,
+    # returns once states holds the results
+    def step(self, ticks=1):
+        self.run_command(FARM_STEP, ticks)
+
+    # Deletes and respawns every world's Marios
+    def reset(self):
+        self.run_command(FARM_RESET)
+
+    # Stops the workers and frees the shared memory
+    def close(self):
+        if self.workers == None:
+            return
+        try:
+            self.run_command(FARM_STOP)
+        except threading.BrokenBarrierError:
+            pass
+        for worker in self.workers:
+            worker.join()
+        self.workers = None
+        self.free_memory()
+
+    def free_memory(self):
+        self.inputs = self.states = self.alive = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,874 @@
+import os
+import sys
+import ctypes as ct
+import hashlib
+import numpy as np
+from panda3d.core import *
+from direct.task import Task
+from direct.stdpy import threading
+from from_blender import *
+from sm64_sim import *
+from sm64_collision import *
+from sm64_streaming import *
+
+# Panda3D Python bindings for libsm64
+# by TheFamiliarScoot
+
+# radius of the sphere Mario's visibility is tested with, in panda units
+SM64_MARIO_CULL_RADIUS = 200 / SM64_SCALE_FACTOR
+
+# vertex rows each Mario gets in a SM64MarioBatch, enough for his biggest mesh
+SM64_BATCH_SLOT_ROWS = SM64_GEO_MAX_TRIANGLES * 3
+
+class SM64State(SM64SimState):
+    # cache_dir holds files derived from the ROM and models (converted texture, compiled collision)
+    # between runs, defaults to "sm64_cache" next to the library
+    # threaded runs the native Mario ticks on their own task chain thread, overlapping rendering
+    # asynchronous loads the library, ROM and texture on a background thread instead of blocking;
+    # await ready_future (or check ready) before using the state for anything but adding
+    # static surfaces and colliders and creating Marios, which are held back until it's ready
+    def __init__(self, dll_directory: str, dll_name_stub: str, rom_path: str, cache_dir: str = None, threaded: bool = False, asynchronous: bool = False):
+        SM64SimState.__init__(self, dll_directory, dll_name_stub, rom_path, load=False)
+
+        self.cache_dir = cache_dir if cache_dir != None else os.path.join(dll_directory, "sm64_cache")
+
+        # filled in by load, from the ROM or a previous run's conversion
+        self.texture = Texture('MarioTex')
+        self.texture.setup2dTexture(SM64_TEXTURE_WIDTH, SM64_TEXTURE_HEIGHT, Texture.T_unsigned_byte, Texture.F_rgba8)
+
+        samp = SamplerState()
+        samp.setMinfilter(SamplerState.FT_nearest)
+        samp.setMagfilter(SamplerState.FT_nearest)
+
+        self.texture.default_sampler = samp
+        self.texture.setAnisotropicDegree(0)
+
+        # world scheduler
+        self.world_task = None
+        self.last_frame_time = None
+        self.tick_accumulator = 0.0
+        # at most this many sim ticks per frame, the rest of a slow frame's backlog is dropped
+        self.max_ticks_per_frame = 4
+
+        # threaded sim handoff, see threaded_world_tick
+        self.threaded = threaded
+        self.task_mgr = None
+        self.sim_done = threading.Event()
+        self.sim_done.set()
+        self.sim_marios = []
+        self.sim_crashed = []
+
+        # geometry culling, see SM64Mario.needs_geometry
+        # Marios outside cull_camera's view (showbase.cam unless set) or further than cull_distance
+        # are only ticked and moved (batched ones aren't drawn at all), and ones past lod_distance
+        # re-upload every lod_interval ticks (batched ones every tick).
+        # Distances are in panda units, None turns that check off
+        self.cull_camera = None
+        self.cull_bounds = None
+        self.cull_distance = None
+        self.lod_distance = None
+        self.lod_interval = 2
+        self.geometry_stats = {'uploaded': 0, 'skipped_hidden': 0, 'skipped_distant': 0}
+
+        # shared single-draw-call renderer for batched Marios, made by the first one
+        self.batch = None
+
+        # geometry dedup, see SM64Mario.update_geometry
+        # geometry_cache maps this frame's geometry hashes to what was uploaded for them
+        self.geometry_dedup = False
+        self.geometry_cache = {}
+        self.dedup_stats = {'unchanged': 0, 'shared': 0, 'misses': 0}
+
+        # moving platforms, see add_collider
+        # only dynamic ones are polled every tick, static ones are synced once marked as moved
+        self.colliders = []
+        self.dynamic_colliders = []
+        self.moved_colliders = []
+
+        # loading; ready_future gets the state as its result once it's ready
+        self.ready_future = AsyncFuture()
+        self.load_done = threading.Event()
+        self.load_error = None
+        self.pending_marios = []
+        if asynchronous:
+            # only pulled in here, importing it creates the global task manager
+            from direct.task.TaskManagerGlobal import taskMgr
+            taskMgr.add(self.wait_for_load, 'SM64StateLoad')
+            threading.Thread(target=self.load_in_background, name='SM64StateLoad', daemon=True).start()
+        else:
+            self.load()
+            self.finish_load()
+    
+    # Loads libsm64 and converts the texture, on whichever thread calls it
+    def load(self):
+        SM64SimState.load(self)
+        self.texture.setRamImage(self.load_texture_image(self.texture_buff))
+
+    def load_in_background(self):
+        try:
+            self.load()
+        except Exception as e:
+            self.load_error = e
+        self.load_done.set()
+
+    # Intended to be run as a task, finishes an asynchronous load on the main thread
+    def wait_for_load(self, task):
+        if not self.load_done.is_set():
+            return Task.cont
+        if self.load_error != None:
+            print("Couldn't create the state: " + str(self.load_error))
+            self.ready_future.cancel()
+            return Task.done
+        self.finish_load()
+        return Task.done
+
+    # Loads the static surfaces added so far and creates the Marios held back until now
+    def finish_load(self):
+        self.ready = True
+        print("State created!")
+        if self.surface_count > 0:
+            self.reload_surfaces()
+        for collider in self.colliders:
+            collider.create(self)
+        pending = self.pending_marios
+        self.pending_marios = []
+        for mario, showbase, pos in pending:
+            mario.create(showbase, self, pos)
+        self.ready_future.setResult(self)
+
+    def __del__(self):
+        self.wait_for_sim()
+        if self.world_task != None:
+            self.world_task.remove()
+        SM64SimState.__del__(self)
+
+    # Starts the world scheduler's task on the first Mario, every Mario added to the state is ticked by it
+    def start_world_task(self, showbase):
+        if self.world_task == None:
+            if self.threaded:
+                showbase.taskMgr.setupTaskChain('SM64Sim', numThreads=1, frameSync=False)
+            self.task_mgr = showbase.taskMgr
+            if self.cull_camera == None:
+                self.cull_camera = showbase.cam
+            self.world_task = showbase.taskMgr.add(self.world_tick, 'SM64WorldTick')
+
+    # Blocks until the threaded sim (if any) is idle, so Marios can be safely changed
+    def wait_for_sim(self):
+        self.sim_done.wait()
+
+    # Works out how many fixed sim ticks this frame owes
+    def count_sim_ticks(self, task):
+        if self.last_frame_time == None:
+            self.last_frame_time = task.time
+            # first frame ticks once so Marios have geometry straight away
+            self.tick_accumulator = SM64_TICK_TIME
+        self.tick_accumulator += task.time - self.last_frame_time
+        self.last_frame_time = task.time
+
+        ticks = 0
+        while self.tick_accumulator >= SM64_TICK_TIME and ticks < self.max_ticks_per_frame:
+            self.tick_accumulator -= SM64_TICK_TIME
+            ticks += 1
+
+        # don't let a slow frame turn into an ever-growing backlog
+        if ticks == self.max_ticks_per_frame:
+            self.tick_accumulator = min(self.tick_accumulator, SM64_TICK_TIME)
+        return ticks
+
+    # Also reports the phases to PStats, as collectors under "SM64"
+    def enable_stats(self, window=300):
+        self.stats = SM64Stats(window, PStatCollector)
+
+    # Intended to be run as a task
+    # Steps every Mario at a fixed SM64_TICK_RATE, independent of the display rate
+    def world_tick(self, task):
+        ticks = self.count_sim_ticks(task)
+        stats = self.stats
+        # only frames that run sim ticks are timed, the rest barely do anything
+        if stats == None or ticks == 0:
+            return self.step_world(ticks)
+        start = stats.begin('frame')
+        result = self.step_world(ticks)
+        stats.end('frame', start)
+        stats.end_tick()
+        return result
+
+    # world_tick's body
+    def step_world(self, ticks):
+        if ticks > 0 and self.cull_camera != None:
+            # the frustum, in the camera's space
+            self.cull_bounds = self.cull_camera.node().getLens().makeBounds()
+        if self.threaded:
+            return self.threaded_world_tick(ticks)
+
+        if ticks == 0:
+            return Task.cont
+        self.geometry_cache = {}
+        self.update_streamers()
+        self.sync_colliders()
+
+        # geometry only needs the latest tick, everything before it is just simulated
+        for mario in self.run_sim_ticks(self.marios, ticks - 1):
+            self.remove_mario(mario)
+
+        # and each Mario only holds a pooled geometry buffer while his last tick is written and uploaded
+        for mario in list(self.marios):
+            upload = mario.needs_geometry(ticks)
+            if upload:
+                mario.lease_geometry()
+            if mario.sim_tick():
+                mario.update_geometry(upload)
+            else:
+                self.remove_mario(mario)
+            mario.release_geometry()
+
+        self.flush_batch()
+        return Task.cont
+
+    # Threaded version of world_tick's body: the ticks for the next frame run on the
+    # SM64Sim chain while this one renders, the main thread only swaps and uploads results
+    def threaded_world_tick(self, ticks):
+        # the ticks started last frame ran while it rendered, pick up their results
+        self.sim_done.wait()
+        for mario in self.sim_crashed:
+            self.remove_mario(mario)
+        for mario in self.sim_marios:
+            # deleted while the sim was running
+            if mario.mario_id != -1 and mario not in self.sim_crashed:
+                mario.swap_sim_buffers()
+                mario.update_position()
+                if mario.sim_upload:
+                    mario.present_geometry()
+            mario.release_geometry()
+        self.flush_batch()
+
+        self.sim_marios = []
+        self.sim_crashed = []
+        if ticks > 0:
+            # libsm64 isn't touched while the sim thread is idle, so surfaces can change now
+            self.update_streamers()
+            self.sync_colliders()
+            self.sim_marios = list(self.marios)
+            # the geometry buffers stay leased until next frame has uploaded them
+            for mario in self.sim_marios:
+                mario.stage_sim_inputs()
+                mario.sim_upload = mario.needs_geometry(ticks)
+                if mario.sim_upload:
+                    mario.lease_geometry()
+            self.sim_done.clear()
+            self.task_mgr.add(self.sim_job, 'SM64Sim', extraArgs=[self.sim_marios, ticks], taskChain='SM64Sim')
+
+        return Task.cont
+
+    # Rebuilds the batch's index buffer if it needs it, once every Mario's been written
+    def flush_batch(self):
+        if self.batch == None or not self.batch.indices_dirty:
+            return
+        stats = self.stats
+        if stats == None:
+            self.batch.flush()
+            return
+        start = stats.begin('indices')
+        stats.add_bytes(self.batch.flush())
+        stats.end('indices', start)
+
+    # Runs on the SM64Sim task chain's thread
+    # Besides the ticks, it does the heavy half of every upload (see SM64Mario.prepare_geometry),
+    # leaving the main thread to just swap the results in
+    def sim_job(self, marios, ticks):
+        try:
+            self.sim_crashed = self.run_sim_ticks(marios, ticks)
+            self.geometry_cache = {}
+            for mario in marios:
+                if mario.sim_upload and mario not in self.sim_crashed:
+                    mario.prepare_geometry(mario.sim_geo, mario.sim_state)
+        finally:
+            self.sim_done.set()
+        return Task.done
+
+    # Returns the texture's RAM image, keyed on disk by the ROM's hash
+    def load_texture_image(self, texture_buff):
+        cache_path = os.path.join(self.cache_dir, f"texture-{self.rom_hash}.bgra")
+        try:
+            with open(cache_path, 'rb') as file:
+                data = file.read()
+            if len(data) == len(texture_buff):
+                return data
+        except OSError:
+            pass
+
+        data = make_image(texture_buff)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(cache_path, 'wb') as file:
+                file.write(data)
+        except OSError:
+            print("Couldn't write the texture cache to " + cache_path)
+        return data
+
+    # Compiles the geometry of the specified nodes and adds it to the static surfaces list,
+    # returns its handle for remove_surfaces
+    # models loaded from files are cached compiled in cache_dir, see precompile_surface_cache
+    # optimize runs optimize_surfaces first; its counts are kept in surface_stats
+    def add_surface_triangles(self, *arg, optimize=False):
+        surfaces = compile_surfaces_cached(arg, self.cache_dir)
+        if optimize:
+            surfaces, self.surface_stats = optimize_surfaces(surfaces)
+            print("Optimized surfaces: " + str(self.surface_stats['before']) + " -> " + str(self.surface_stats['after']))
+        return self.add_surfaces(surfaces)
+
+    # Snaps every spawn point (in libsm64 units) onto the floor under it and creates a Mario there,
+    # returns the Marios, None for points without a floor. Extra arguments go to SM64Mario
+    def spawn_marios(self, showbase, points, **kwargs):
+        snapped, valid = self.snap_spawn_points(points)
+        marios = []
+        for point, ok in zip(snapped, valid):
+            mario = SM64Mario(showbase, self, Point3(*point), **kwargs) if ok else None
+            marios.append(mario if mario != None and mario.mario_id != -1 else None)
+        return marios
+
+    # Makes the geometry under a NodePath a moving platform that follows it around
+    # Its collision is compiled once; from then on only its net transform is synced, and only when it changed
+    # dynamic=False is for platforms that rarely move: they aren't checked every tick,
+    # only on the tick after their mark_moved is called, so hundreds of them cost nothing while still.
+    # On a state that's still loading, it's created natively once it's done
+    def add_collider(self, nodePath, surftype=COLLISION_TYPES['SURFACE_DEFAULT'], terrain=COLLISION_TYPES['TERRAIN_GRASS'], dynamic=True):
+        self.wait_for_sim()
+        collider = SM64Collider(self, nodePath, surftype, terrain, dynamic)
+        if self.ready:
+            collider.create(self)
+        self.colliders.append(collider)
+        if dynamic:
+            self.dynamic_colliders.append(collider)
+        return collider
+
+    def remove_collider(self, collider):
+        self.wait_for_sim()
+        self.colliders.remove(collider)
+        if collider.dynamic:
+            self.dynamic_colliders.remove(collider)
+        if collider in self.moved_colliders:
+            self.moved_colliders.remove(collider)
+        if collider.object_id != None:
+            self.delete_surface_object(collider.object_id)
+
+    # Sends libsm64 the transforms of every collider that moved since the last sync, returns how many did
+    def sync_colliders(self):
+        moved = 0
+        if len(self.dynamic_colliders) == 0 and len(self.moved_colliders) == 0:
+            return moved
+        stats = self.stats
+        if stats != None:
+            start = stats.begin('colliders')
+        for collider in self.dynamic_colliders:
+            if collider.sync(self):
+                moved += 1
+        for collider in self.moved_colliders:
+            if collider.sync(self):
+                moved += 1
+        self.moved_colliders = []
+        if stats != None:
+            stats.end('colliders', start)
+        return moved
+
+# the shaders live next to this file, wherever it's run from
+SHADER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shaders")
+
+# Sets up the vertex formats and loads the shader the first time a Mario needs them,
+# so importing this module doesn't register formats or touch the disk
+def load_mario_resources():
+    if SM64Mario.shader != None:
+        return
+
+    # Vertex Formats
+    # one array per attribute, each laid out exactly like its libsm64 geometry buffer
+    # so every tick is just four straight memory copies
+    vf_vertex = GeomVertexArrayFormat()
+    vf_vertex.addColumn("vertex", 3, Geom.NTFloat32, Geom.CPoint)
+    vf_normal = GeomVertexArrayFormat()
+    vf_normal.addColumn("normal", 3, Geom.NTFloat32, Geom.CNormal)
+    vf_color = GeomVertexArrayFormat()
+    vf_color.addColumn("color", 3, Geom.NTFloat32, Geom.CColor)
+    vf_texcoord = GeomVertexArrayFormat()
+    vf_texcoord.addColumn("texcoord", 2, Geom.NTFloat32, Geom.CTexcoord)
+
+    vformat = GeomVertexFormat()
+    vformat.addArray(vf_vertex)
+    vformat.addArray(vf_normal)
+    vformat.addArray(vf_color)
+    vformat.addArray(vf_texcoord)
+    SM64Mario.vformat = GeomVertexFormat.registerFormat(vformat)
+
+    # compact variant: positions stay float32, everything else is packed into one
+    # 12 byte array (int8 normals, uint8 rgba, uint16 uvs) for 24 bytes per vertex instead of 44
+    # integer columns other than color reach the shader unnormalized, see sm64_texcoord_scale
+    vf_compact = GeomVertexArrayFormat()
+    vf_compact.addColumn("normal", 3, Geom.NTInt8, Geom.CNormal, 0)
+    vf_compact.addColumn("color", 4, Geom.NTUint8, Geom.CColor, 4)
+    vf_compact.addColumn("texcoord", 2, Geom.NTUint16, Geom.CTexcoord, 8)
+    vf_compact.setStride(12)
+
+    vformat_compact = GeomVertexFormat()
+    vformat_compact.addArray(vf_vertex)
+    vformat_compact.addArray(vf_compact)
+    SM64Mario.vformat_compact = GeomVertexFormat.registerFormat(vformat_compact)
+
+    # Shaders
+    SM64Mario.shader = Shader.load(Shader.SL_GLSL,
+                     vertex=Filename.fromOsSpecific(os.path.join(SHADER_DIR, "mario.vsh")),
+                     fragment=Filename.fromOsSpecific(os.path.join(SHADER_DIR, "mario.fsh")))
+
+class SM64Mario(NodePath, SM64SimMario):
+    # set up by load_mario_resources
+    vformat = None
+    vformat_compact = None
+    shader = None
+
+    # matches vformat_compact's second array, used to batch-convert the libsm64 float buffers
+    compact_dtype = np.dtype({
+        'names': ['normal', 'color', 'texcoord'],
+        'formats': [(np.int8, 3), (np.uint8, 4), (np.uint16, 2)],
+        'offsets': [0, 4, 8],
+        'itemsize': 12
+    })
+    
+    # libsm64 space (Y up, scaled up) to panda space (Z up), used by the shader transform
+    sm64_to_panda = Mat4.scaleMat(1 / SM64_SCALE_FACTOR) * Mat4.convertMat(CS_yup_right, CS_zup_right)
+
+    # gpu_transform uploads raw libsm64 positions and lets the vertex shader
+    # recenter, scale and axis-swap them, leaving the upload a straight memcpy
+    # compact uses vformat_compact, roughly halving the per-tick vertex upload
+    # batched draws Mario as part of the state's SM64MarioBatch instead of his own node,
+    # so gpu_transform and compact don't apply
+    def __init__(self, showbase, state, pos, gpu_transform=False, compact=False, geometry=True, batched=False):
+        load_mario_resources()
+        self.mario_node = GeomNode('MarioNode')
+        self.gpu_transform = gpu_transform
+        self.compact = compact
+
+        # nodepath things
+        NodePath.__init__(self, self.mario_node)
+        NodePath.setPos(self, pos.getX(), pos.getY(), pos.getZ())
+        if not self.gpu_transform:
+            NodePath.setHpr(self, 0, 90, 0)
+
+        self.mario_id = -1
+
+        if showbase == None:
+            print("Showbase does not exist!")
+            del self
+            return
+        if state == None:
+            print("State does not exist!")
+            del self
+            return
+
+        # geometry buffers come from the state's pool each tick instead of being owned,
+        # and Marios without geometry (invisible ones, stand-ins) never take one
+        self.geometry = geometry
+        self.batched = batched
+        self.uploaded = False
+        self.ticks_since_upload = 0
+        self.batch_slot = None
+        self.geometry_key = None
+        self.sim_upload = False
+        self.pending_vertices = None
+        self.pending_batch = False
+        self.mario_inputs = None
+        self.mario_state = None
+
+        # a state that's still loading creates him once it's done,
+        # until then inputs and state go into placeholders, and the inputs are carried over
+        if not state.ready:
+            self.sm64_state = state
+            self.mario_inputs = SM64MarioInputs()
+            self.mario_state = SM64MarioState()
+            state.pending_marios.append((self, showbase, pos))
+            return
+        self.create(showbase, state, pos)
+
+    # Sets up the buffers and creates Mario natively
+    def create(self, showbase, state, pos):
+        queued_inputs = self.mario_inputs
+        if not self.init_sim(state, pos.getX(), pos.getY(), pos.getZ(), geometry=False):
+            # nothing's left of him but an empty node, take that out too
+            NodePath.removeNode(self)
+            return
+        if queued_inputs != None:
+            ct.memmove(ct.byref(self.mario_inputs), ct.byref(queued_inputs), ct.sizeof(SM64MarioInputs))
+        self.setName('MarioNode' + str(self.mario_id))
+
+        if self.batched:
+            if state.batch == None:
+                state.batch = SM64MarioBatch(state.texture)
+                state.batch.reparentTo(showbase.render)
+            self.batch_slot = state.batch.allocate_slot()
+            state.add_mario(self)
+            state.start_world_task(showbase)
+            print("Mario (id " + str(self.mario_id) + ") created and spawned at " + str(pos) + ", batched")
+            return
+
+        # vertex data
+        # two persistent buffers rewritten in place; we fill the back one while the
+        # renderer still holds the front one, then swap
+        vformat = SM64Mario.vformat_compact if self.compact else SM64Mario.vformat
+        # bytes per vertex over all the arrays, for the upload stats
+        self.mario_vertex_size = sum(vformat.getArray(i).getStride() for i in range(vformat.getNumArrays()))
+        self.mario_vdata_buffers = []
+        for i in range(2):
+            vdata = GeomVertexData('mario-vertex-' + str(i), vformat, Geom.UHDynamic)
+            vdata.setNumRows(SM64_GEO_MAX_TRIANGLES * 3)
+            self.mario_vdata_buffers.append(vdata)
+        self.mario_vdata_index = 0
+        self.mario_vdata = None
+        self.mario_num_triangles = 0
+        self.mario_geom = None
+        if self.compact:
+            # conversion scratch, alpha never changes
+            self.mario_packed = np.zeros(SM64_GEO_MAX_TRIANGLES * 3, SM64Mario.compact_dtype)
+            self.mario_packed['color'][:, 3] = 255
+
+        # textures
+        NodePath.setTexture(self, self.sm64_state.texture)
+        NodePath.setShader(self, SM64Mario.shader)
+        NodePath.setShaderInput(self, 'sm64_local_transform', Mat4.identMat())
+        NodePath.setShaderInput(self, 'sm64_texcoord_scale', LVecBase2f(1.0 / 65535 if self.compact else 1.0))
+        if self.gpu_transform:
+            # vertices stay in libsm64 world space, so the computed bounds would be meaningless
+            self.mario_node.setBounds(OmniBoundingVolume())
+            self.mario_node.setFinal(True)
+
+        # ticked from the state's world task from now on
+        state.add_mario(self)
+        state.start_world_task(showbase)
+
+        # let the user know
+        print("Mario (id " + str(self.mario_id) + ") created and spawned at " + str(pos))
+    
+    # Fills an existing VertexData with Mario's geometry, in place
+    # only the rows for the triangles libsm64 actually used this tick are uploaded
+    def fill_mario_vdata(self, vdata, geo, ms):
+        num_verts = geo.numTrianglesUsed * 3
+
+        # bulk copies straight out of the ctypes buffers, no per-vertex python
+        # (the V flip is baked into the texture instead, its rows are stored bottom-up, so uvs go up as-is)
+        vdata.modifyArrayHandle(0).copyDataFrom(memoryview(geo.position_data).cast('B')[:num_verts * 3 * 4])
+        if self.compact:
+            self.pack_mario_attributes(vdata, geo, num_verts)
+        else:
+            vdata.modifyArrayHandle(1).copyDataFrom(memoryview(geo.normal_data).cast('B')[:num_verts * 3 * 4])
+            vdata.modifyArrayHandle(2).copyDataFrom(memoryview(geo.color_data).cast('B')[:num_verts * 3 * 4])
+            vdata.modifyArrayHandle(3).copyDataFrom(memoryview(geo.uv_data).cast('B')[:num_verts * 2 * 4])
+
+        # recenter on mario and scale down, done natively over the whole vertex column
+        # (or left to the vertex shader entirely)
+        if self.gpu_transform:
+            return
+        vdata.transformVertices(Mat4.translateMat(-ms.posX, -ms.posY, -ms.posZ) * Mat4.scaleMat(1 / SM64_SCALE_FACTOR))
+
+    # Converts normals, colors and uvs into the compact array in one batch each
+    def pack_mario_attributes(self, vdata, geo, num_verts):
+        packed = self.mario_packed[:num_verts]
+        normals = np.frombuffer(geo.normal_data, np.float32, num_verts * 3).reshape(-1, 3)
+        colors = np.frombuffer(geo.color_data, np.float32, num_verts * 3).reshape(-1, 3)
+        uvs = np.frombuffer(geo.uv_data, np.float32, num_verts * 2).reshape(-1, 2)
+
+        packed['normal'] = np.rint(normals * 127)
+        packed['color'][:, :3] = np.rint(np.clip(colors, 0, 1) * 255)
+        packed['texcoord'] = np.rint(np.clip(uvs, 0, 1) * 65535)
+
+        vdata.modifyArrayHandle(1).copyDataFrom(packed.view(np.uint8))
+
+    # Threaded sim only: the sim's latest results become the front buffers
+    # his geometry buffer is leased per tick (see lease_geometry), so both point at the latest one
+    def swap_sim_buffers(self):
+        ct.memmove(ct.byref(self.mario_state), ct.byref(self.sim_state), ct.sizeof(SM64MarioState))
+        self.mario_geo = self.sim_geo
+
+    # Borrows a geometry buffer from the state's pool for the next tick to write into
+    def lease_geometry(self):
+        if self.geometry:
+            self.mario_geo = self.sim_geo = self.sm64_state.geometry_pool.lease()
+
+    # Gives the buffer back once its geometry is uploaded, later ticks go to scratch
+    def release_geometry(self):
+        if self.sim_geo is not self.sm64_state.scratch_geo:
+            self.sm64_state.geometry_pool.release(self.sim_geo)
+        self.mario_geo = self.sim_geo = self.sm64_state.scratch_geo
+
+    # Decides whether the next ticks' geometry gets uploaded, counting the ones that don't
+    # Culled Marios keep their last uploaded geometry, moved along with their node
+    def needs_geometry(self, ticks):
+        if not self.geometry:
+            return False
+        self.ticks_since_upload += ticks
+        state = self.sm64_state
+        if state.cull_camera == None or not self.uploaded:
+            state.geometry_stats['uploaded'] += 1
+            self.ticks_since_upload = 0
+            return True
+
+        pos = NodePath.getPos(self, state.cull_camera)
+        distance = pos.length()
+        if state.cull_distance != None and distance > state.cull_distance:
+            state.geometry_stats['skipped_distant'] += 1
+            self.hide_batch_slot()
+            return False
+        if state.cull_bounds != None and not state.cull_bounds.contains(BoundingSphere(pos, SM64_MARIO_CULL_RADIUS)):
+            state.geometry_stats['skipped_hidden'] += 1
+            self.hide_batch_slot()
+            return False
+        # batched geometry doesn't follow his node, so it's never left a tick behind
+        if self.batch_slot == None and state.lod_distance != None and distance > state.lod_distance and self.ticks_since_upload < state.lod_interval:
+            state.geometry_stats['skipped_distant'] += 1
+            return False
+
+        state.geometry_stats['uploaded'] += 1
+        self.ticks_since_upload = 0
+        return True
+
+    # Batched geometry is in world space and stays where it was uploaded, so a culled batched
+    # Mario is taken out of the batch until his next upload instead of being left behind
+    def hide_batch_slot(self):
+        if self.batch_slot != None:
+            self.sm64_state.batch.clear_slot(self.batch_slot)
+            # so dedup doesn't skip putting him back
+            self.geometry_key = None
+
+    # Brings the node and visual geometry up to date with the latest sim tick
+    # Only needs to run once per frame, however many sim ticks that frame took
+    # upload=False only moves the node, see needs_geometry
+    def update_geometry(self, upload=True):
+        self.update_position()
+        # update his visual geometry
+        if upload:
+            self.prepare_geometry(self.mario_geo, self.mario_state)
+            self.present_geometry()
+
+    # Moves the node to where libsm64 last put him
+    def update_position(self):
+        ms = self.mario_state
+        NodePath.setPos(self, ms.posX / SM64_SCALE_FACTOR, -ms.posZ / SM64_SCALE_FACTOR, ms.posY / SM64_SCALE_FACTOR)
+
+    # First half of an upload, does the copying and converting without touching anything being drawn,
+    # so the threaded sim runs it on its own thread (see SM64State.sim_job). geo and ms are the
+    # buffers the tick was written to. What's ready for present_geometry is left in pending_vertices
+    # (or pending_batch for batched Marios), along with the bytes written for the stats
+    def prepare_geometry(self, geo, ms):
+        self.uploaded = True
+        self.pending_vertices = None
+        self.pending_batch = False
+        self.pending_bytes = 0
+
+        # with geometry_dedup, geometry identical to what's already shown is skipped,
+        # and geometry identical to another Mario's this frame reuses his upload
+        state = self.sm64_state
+        stats = state.stats
+        if state.geometry_dedup:
+            if stats != None:
+                start = stats.begin('hash')
+            key = self.geometry_hash(geo, ms)
+            if stats != None:
+                stats.end('hash', start, self.mario_id)
+            if key == self.geometry_key:
+                state.dedup_stats['unchanged'] += 1
+                return
+            self.geometry_key = key
+            shared = state.geometry_cache.get(key) if self.batch_slot == None else None
+            if shared != None:
+                state.dedup_stats['shared'] += 1
+                vdata, num_triangles, local_transform = shared
+                # the copy shares his vertex arrays until either of them gets written to
+                self.pending_vertices = (GeomVertexData(vdata), num_triangles, local_transform, False)
+                return
+            state.dedup_stats['misses'] += 1
+
+        # the batch's one vertex buffer is always being drawn, so it's only written by present_geometry
+        if self.batch_slot != None:
+            self.pending_batch = True
+            return
+        local_transform = None
+        if self.gpu_transform:
+            # has to match the uploaded vertices, so it's only moved along with them
+            local_transform = Mat4.translateMat(-ms.posX, -ms.posY, -ms.posZ) * SM64Mario.sm64_to_panda
+
+        # writes the geo into the back buffer, which present_geometry then makes the front one
+        vdata = self.mario_vdata_buffers[self.mario_vdata_index ^ 1]
+        if stats == None:
+            self.fill_mario_vdata(vdata, geo, ms)
+        else:
+            start = stats.begin('vertices')
+            self.fill_mario_vdata(vdata, geo, ms)
+            stats.end('vertices', start, self.mario_id)
+            self.pending_bytes = geo.numTrianglesUsed * 3 * self.mario_vertex_size
+        self.pending_vertices = (vdata, geo.numTrianglesUsed, local_transform, True)
+
+        if state.geometry_dedup:
+            state.geometry_cache[key] = (vdata, geo.numTrianglesUsed, local_transform)
+
+    # Second half of an upload, on the main thread: swaps in what prepare_geometry made
+    def present_geometry(self):
+        state = self.sm64_state
+        stats = state.stats
+        if self.pending_batch:
+            self.pending_batch = False
+            if stats == None:
+                state.batch.write_slot(self.batch_slot, self.mario_geo)
+                return
+            start = stats.begin('batch')
+            stats.add_bytes(state.batch.write_slot(self.batch_slot, self.mario_geo))
+            stats.end('batch', start, self.mario_id)
+            return
+        if self.pending_vertices == None:
+            return
+        vdata, num_triangles, local_transform, own = self.pending_vertices
+        self.pending_vertices = None
+
+        if stats != None:
+            stats.add_bytes(self.pending_bytes)
+            start = stats.begin('primitive')
+        if own:
+            self.mario_vdata_index ^= 1
+            self.mario_vdata = vdata
+        self.set_geom_vertices(vdata, num_triangles)
+        if self.gpu_transform:
+            NodePath.setShaderInput(self, 'sm64_local_transform', local_transform)
+        if stats != None:
+            stats.end('primitive', start, self.mario_id)
+
+    # Points Mario's geom at the given vertex data, making the geom the first time
+    def set_geom_vertices(self, vdata, num_triangles):
+        if self.mario_geom == None:
+            # triangles are never indexed, so the primitive is just a vertex range
+            prim = GeomTriangles(Geom.UHDynamic)
+            prim.setNonindexedVertices(0, num_triangles * 3)
+            self.mario_num_triangles = num_triangles
+
+            self.mario_geom = Geom(vdata)
+            self.mario_geom.addPrimitive(prim)
+
+            self.mario_node.addGeom(self.mario_geom)
+        else:
+            # libsm64 can report a different count later on (caps, animations), so resize the range.
+            # Filled arrays only have rows for the used triangles, and the geom checks its range
+            # against new vertex data, so a shrinking range has to shrink first
+            if num_triangles < self.mario_num_triangles:
+                self.mario_geom.modifyPrimitive(0).setNonindexedVertices(0, num_triangles * 3)
+            self.mario_geom.setVertexData(vdata)
+            if num_triangles > self.mario_num_triangles:
+                self.mario_geom.modifyPrimitive(0).setNonindexedVertices(0, num_triangles * 3)
+            self.mario_num_triangles = num_triangles
+
+    # Hashes the used part of Mario's geometry, recentered on him so it doesn't depend on where he is
+    # Batched geometry is stored in world space, so for him his position counts too
+    def geometry_hash(self, geo, ms):
+        num_verts = geo.numTrianglesUsed * 3
+        position = np.array([ms.posX, ms.posY, ms.posZ], np.float32)
+        positions = np.frombuffer(geo.position_data, np.float32, num_verts * 3).reshape(-1, 3) - position
+
+        key = hashlib.blake2b(positions.tobytes(), digest_size=16)
+        key.update(memoryview(geo.normal_data).cast('B')[:num_verts * 3 * 4])
+        key.update(memoryview(geo.color_data).cast('B')[:num_verts * 3 * 4])
+        key.update(memoryview(geo.uv_data).cast('B')[:num_verts * 2 * 4])
+        # only Marios with the same vertex format can share
+        key.update(bytes([self.compact, self.gpu_transform]))
+        if self.batch_slot != None:
+            key.update(position.tobytes())
+        return key.digest()
+
+    # Stops ticking this Mario, frees him natively and removes his node
+    def delete(self):
+        if self.mario_id == -1:
+            # never created, but maybe still waiting on a loading state
+            state = getattr(self, 'sm64_state', None)
+            if state != None:
+                state.pending_marios = [entry for entry in state.pending_marios if entry[0] is not self]
+            return
+        self.sm64_state.wait_for_sim()
+        if self.batch_slot != None:
+            self.sm64_state.batch.free_slot(self.batch_slot)
+            self.batch_slot = None
+        SM64SimMario.delete(self)
+        NodePath.removeNode(self)
+
+    def setPos(self, x, y, z):
+        SM64SimMario.setPos(self, x, y, z)
+
+# Draws any number of Marios with one Geom, so one draw call
+# Every Mario has a fixed slot of SM64_BATCH_SLOT_ROWS rows in a single dynamic vertex buffer,
+# written in this node's space, and the index buffer lists just the rows each slot uses
+class SM64MarioBatch(NodePath):
+    def __init__(self, texture, capacity=16):
+        load_mario_resources()
+        self.batch_node = GeomNode('MarioBatch')
+        NodePath.__init__(self, self.batch_node)
+
+        self.vdata = GeomVertexData('mario-batch', SM64Mario.vformat, Geom.UHDynamic)
+        self.vdata.setNumRows(capacity * SM64_BATCH_SLOT_ROWS)
+        prim = GeomTriangles(Geom.UHDynamic)
+        prim.setIndexType(Geom.NT_uint32)
+        self.geom = Geom(self.vdata)
+        self.geom.addPrimitive(prim)
+        self.batch_node.addGeom(self.geom)
+
+        # vertices used per slot, None for free slots
+        self.slot_rows = [None] * capacity
+        self.indices_dirty = False
+
+        NodePath.setTexture(self, texture)
+        NodePath.setShader(self, SM64Mario.shader)
+        NodePath.setShaderInput(self, 'sm64_local_transform', Mat4.identMat())
+        NodePath.setShaderInput(self, 'sm64_texcoord_scale', LVecBase2f(1.0))
+        # the crowd covers wherever its Marios are, not worth recomputing every frame
+        self.batch_node.setBounds(OmniBoundingVolume())
+        self.batch_node.setFinal(True)
+
+    # Takes the first free slot, doubling the buffer if there's none
+    def allocate_slot(self):
+        if None not in self.slot_rows:
+            self.slot_rows += [None] * len(self.slot_rows)
+            self.vdata.setNumRows(len(self.slot_rows) * SM64_BATCH_SLOT_ROWS)
+        slot = self.slot_rows.index(None)
+        self.slot_rows[slot] = 0
+        return slot
+
+    def free_slot(self, slot):
+        if self.slot_rows[slot] != 0:
+            self.indices_dirty = True
+        self.slot_rows[slot] = None
+
+    # Stops drawing a slot until it's written again
+    def clear_slot(self, slot):
+        if self.slot_rows[slot] != 0:
+            self.slot_rows[slot] = 0
+            self.indices_dirty = True
+
+    # Copies a Mario's geometry into his slot and moves it from libsm64 space into this node's,
+    # returns how many bytes were written
+    def write_slot(self, slot, geo):
+        num_verts = geo.numTrianglesUsed * 3
+        start = slot * SM64_BATCH_SLOT_ROWS
+        columns = (geo.position_data, geo.normal_data, geo.color_data, geo.uv_data)
+        written = 0
+        for i, width in enumerate((3, 3, 3, 2)):
+            data = memoryview(columns[i]).cast('B')[:num_verts * width * 4]
+            self.vdata.modifyArrayHandle(i).copySubdataFrom(start * width * 4, len(data), data)
+            written += len(data)
+        self.vdata.transformVertices(SM64Mario.sm64_to_panda, start, start + num_verts)
+
+        if self.slot_rows[slot] != num_verts:
+            self.slot_rows[slot] = num_verts
+            self.indices_dirty = True
+        return written
+
+    # Rebuilds the index buffer if any slot's size changed, once per frame,
+    # returns how many bytes were written
+    def flush(self):
+        if not self.indices_dirty:
+            return 0
+        self.indices_dirty = False
+        ranges = [np.arange(slot * SM64_BATCH_SLOT_ROWS, slot * SM64_BATCH_SLOT_ROWS + rows, dtype=np.uint32)
+                  for slot, rows in enumerate(self.slot_rows) if rows]
+        indices = np.concatenate(ranges) if len(ranges) > 0 else np.zeros(0, np.uint32)
+        self.geom.modifyPrimitive(0).modifyVertices(len(indices)).modifyHandle().copyDataFrom(indices)
+        return indices.nbytes
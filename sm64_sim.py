@@ -0,0 +1,515 @@
+import os
+import sys
+import ctypes as ct
+import numpy as np
+from from_blender import *
+from sm64_surfaces import *
+from sm64_spatial import *
+from sm64_stats import *
+
+# Headless libsm64 simulation
+# No Panda imports here, nothing is rendered and no texture is built, so this is
+# all a pure simulation workload (training, replays, servers) needs to import.
+# sm64.SM64State and sm64.SM64Mario build their rendering on top of these
+
+# libsm64 simulates at the game's native rate
+SM64_TICK_RATE = 30
+SM64_TICK_TIME = 1.0 / SM64_TICK_RATE
+
+# numpy views of the ctypes structs, same layout and padding
+SM64_INPUTS_DTYPE = np.dtype(SM64MarioInputs)
+SM64_STATE_DTYPE = np.dtype(SM64MarioState)
+
+# how many Marios the state's input/state arrays hold before they first grow
+SM64_INITIAL_MARIO_SLOTS = 16
+
+# same for the static surface buffer, in triangles
+SM64_INITIAL_SURFACES = 1024
+
+class UnsupportedOSError(Exception):
+    pass
+
+# Resolves the shared library's file name for this platform
+def library_name(dll_name_stub: str):
+    if sys.platform.startswith("darwin"):
+        # TODO(patchmixolydic): is this right? i don't macOS
+        return f"lib{dll_name_stub}.dylib"
+    elif sys.platform == "win32" or sys.platform == "cygwin":
+        return f"{dll_name_stub}.dll"
+    elif sys.platform == "linux" or sys.platform.startswith("freebsd"):
+        # TODO(patchmixolydic): this might also hold for AIX
+        return f"lib{dll_name_stub}.so"
+    else:
+        raise UnsupportedOSError(f"libsm64-panda currently doesn't support your platform ({sys.platform})")
+
+# Hands out geometry buffers for as long as a Mario's tick and upload take, so the
+# number allocated follows how many Marios render at once rather than how many exist
+class SM64GeometryPool:
+    def __init__(self):
+        self.free = []
+        self.allocated = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+
+    def lease(self):
+        if len(self.free) == 0:
+            self.free.append(SM64MarioGeometryBuffers())
+            self.allocated += 1
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return self.free.pop()
+
+    def release(self, geo):
+        self.in_use -= 1
+        self.free.append(geo)
+
+class SM64SimState:
+    # load=False leaves loading libsm64 to a later load() call, see SM64State's asynchronous
+    def __init__(self, dll_directory: str, dll_name_stub: str, rom_path: str, load: bool = True):
+        self.library_path = os.path.join(dll_directory, library_name(dll_name_stub))
+        self.rom_path = rom_path
+        self.sm64 = None
+        self.ready = False
+
+        self.marios = []
+        self.threaded = False
+        # SM64SurfaceStreamers updated before every tick
+        self.streamers = []
+
+        # every Mario's inputs and state live in one contiguous array each, one slot per Mario.
+        # inputs and states are structured numpy views of them for vectorized reads and writes,
+        # slot_active says which slots hold a live Mario and slot_marios which one.
+        # They're replaced when the arrays grow, so don't hold on to them across Mario creation
+        self.slot_marios = []
+        self.inputs_buffer = None
+        self.states_buffer = None
+        self.grow_slots(SM64_INITIAL_MARIO_SLOTS)
+
+        # static surface registry, see add_surfaces
+        # every group's surfaces sit back to back at the start of surface_buffer,
+        # surface_groups maps each handle to its [start, count] in it
+        self.surface_buffer = make_surface_array(SM64_INITIAL_SURFACES)
+        self.surface_count = 0
+        self.surface_groups = {}
+        self.next_surface_handle = 1
+        self.static_surfaces = self.surface_buffer[:0]
+        # for collision queries, each group's [min x, min z, max x, max z] bounds and its grid index,
+        # built the first time a query comes near it and kept until the group is removed
+        self.group_bounds = {}
+        self.group_grids = {}
+        self.surface_object_count = 0
+
+        # written to by Marios that don't need their geometry, never read
+        self.scratch_geo = SM64MarioGeometryBuffers()
+        # geometry for the ticks that do get read, see SM64GeometryPool
+        self.geometry_pool = SM64GeometryPool()
+
+        # per-phase timings, None (and free) unless enable_stats was called
+        self.stats = None
+
+        if load:
+            self.load()
+            self.ready = True
+
+    def __del__(self):
+        if self.ready:
+            self.sm64.sm64_global_terminate()
+
+    # Loads the library and the ROM and initializes libsm64
+    def load(self):
+        # the ROM's texture atlas, only used by SM64State
+        self.texture_buff = init_sm64(self, self.library_path, self.rom_path)
+
+    # Starts timing every phase of the ticks, see SM64Stats; window is how many samples the rolling figures cover
+    def enable_stats(self, window=300):
+        self.stats = SM64Stats(window)
+
+    def disable_stats(self):
+        self.stats = None
+
+    # The rolling timings, for one Mario or all of them (see SM64Stats.summary), or None if stats are off
+    def get_stats(self, mario=None):
+        if self.stats == None:
+            return None
+        return self.stats.summary(mario.mario_id if mario != None else None)
+
+    # Headless states tick on the caller's thread, so there's never a sim to wait for
+    def wait_for_sim(self):
+        pass
+
+    # Replaces every static surface with a surface array (see sm64_surfaces), returns its handle
+    def load_static_surfaces(self, surfaces):
+        self.surface_groups = {}
+        self.group_bounds = {}
+        self.group_grids = {}
+        self.surface_count = 0
+        return self.add_surfaces(surfaces)
+
+    # Adds a surface array to the static surfaces, returns a handle for remove_surfaces
+    # The array is copied to the end of the buffer and libsm64 reloads once,
+    # or not at all with reload=False, for batching several changes into one reload_surfaces
+    def add_surfaces(self, surfaces, reload=True):
+        end = self.surface_count + len(surfaces)
+        if end > len(self.surface_buffer):
+            buffer = make_surface_array(max(end, len(self.surface_buffer) * 2))
+            buffer[:self.surface_count] = self.surface_buffer[:self.surface_count]
+            self.surface_buffer = buffer
+        self.surface_buffer[self.surface_count:end] = surfaces
+
+        handle = self.next_surface_handle
+        self.next_surface_handle += 1
+        self.surface_groups[handle] = [self.surface_count, len(surfaces)]
+        if len(surfaces) > 0:
+            xz = surfaces['vertices'][:, :, [0, 2]].reshape(-1, 2)
+            self.group_bounds[handle] = np.concatenate([xz.min(axis=0), xz.max(axis=0)]).astype(np.float64)
+        self.surface_count = end
+        if reload:
+            self.reload_surfaces()
+        return handle
+
+    # Takes a group added by add_surfaces back out, closing the gap behind it, and reloads once
+    def remove_surfaces(self, handle, reload=True):
+        start, count = self.surface_groups.pop(handle)
+        self.group_bounds.pop(handle, None)
+        self.group_grids.pop(handle, None)
+        self.surface_buffer[start:self.surface_count - count] = self.surface_buffer[start + count:self.surface_count]
+        for group in self.surface_groups.values():
+            if group[0] > start:
+                group[0] -= count
+        self.surface_count -= count
+        if reload:
+            self.reload_surfaces()
+
+    # Returns the surfaces of a group added by add_surfaces, a view into the buffer
+    def get_surfaces(self, handle):
+        start, count = self.surface_groups[handle]
+        return self.surface_buffer[start:start + count]
+
+    # Surfaces added before the state is ready are loaded once it is
+    def reload_surfaces(self):
+        self.wait_for_sim()
+        self.static_surfaces = self.surface_buffer[:self.surface_count]
+        if self.ready:
+            self.sm64.sm64_static_surfaces_load(surfaces_pointer(self.static_surfaces), self.surface_count)
+
+    # Collision queries over the static surfaces, see SM64SurfaceGrid
+    # Only the groups near the queried points are searched, each with its own grid, so adding or
+    # removing a group (like a streamed chunk) leaves every other group's grid as it was.
+    # Surface indices are into static_surfaces. Surface objects aren't included
+    def get_group_grid(self, handle):
+        grid = self.group_grids.get(handle)
+        if grid == None:
+            grid = self.group_grids[handle] = SM64SurfaceGrid(self.get_surfaces(handle))
+        return grid
+
+    # Each group whose bounds come within margin of the [min x, min z, max x, max z] boxes,
+    # with its start in static_surfaces and which of the boxes it's near
+    def groups_near(self, boxes, margin):
+        for handle, bounds in self.group_bounds.items():
+            near = ((boxes[:, 0] <= bounds[2] + margin) & (boxes[:, 2] >= bounds[0] - margin) &
+                    (boxes[:, 1] <= bounds[3] + margin) & (boxes[:, 3] >= bounds[1] - margin))
+            if near.any():
+                yield self.get_group_grid(handle), self.surface_groups[handle][0], near
+
+    def floor_heights(self, points, above=SM64_FLOOR_ABOVE):
+        points = np.asarray(points, np.float64).reshape(-1, 3)
+        heights = np.full(len(points), np.nan)
+        surfaces = np.full(len(points), -1, np.int64)
+        for grid, start, near in self.groups_near(points[:, [0, 2, 0, 2]], 0):
+            group_heights, group_surfaces = grid.floor_heights(points[near], above)
+            # NaN compares false, so any floor beats none
+            higher = (group_surfaces != -1) & ~(group_heights <= heights[near])
+            rows = np.flatnonzero(near)[higher]
+            heights[rows] = group_heights[higher]
+            surfaces[rows] = group_surfaces[higher] + start
+        return heights, surfaces
+
+    def nearest_walls(self, points, radius=SM64_WALL_RADIUS):
+        points = np.asarray(points, np.float64).reshape(-1, 3)
+        distances = np.full(len(points), np.inf)
+        surfaces = np.full(len(points), -1, np.int64)
+        for grid, start, near in self.groups_near(points[:, [0, 2, 0, 2]], radius):
+            group_distances, group_surfaces = grid.nearest_walls(points[near], radius)
+            closer = group_distances < distances[near]
+            rows = np.flatnonzero(near)[closer]
+            distances[rows] = group_distances[closer]
+            surfaces[rows] = group_surfaces[closer] + start
+        return distances, surfaces
+
+    def raycast(self, origins, directions, max_distance):
+        origins = np.asarray(origins, np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, np.float64).reshape(-1, 3)
+        ends = origins + directions / np.maximum(np.linalg.norm(directions, axis=1), 1e-12)[:, None] * max_distance
+        boxes = np.concatenate([np.minimum(origins, ends)[:, [0, 2]], np.maximum(origins, ends)[:, [0, 2]]], axis=1)
+        distances = np.full(len(origins), np.inf)
+        surfaces = np.full(len(origins), -1, np.int64)
+        points = np.full((len(origins), 3), np.nan)
+        for grid, start, near in self.groups_near(boxes, 0):
+            group_distances, group_surfaces, group_points = grid.raycast(origins[near], directions[near], max_distance)
+            closer = group_distances < distances[near]
+            rows = np.flatnonzero(near)[closer]
+            distances[rows] = group_distances[closer]
+            surfaces[rows] = group_surfaces[closer] + start
+            points[rows] = group_points[closer]
+        return distances, surfaces, points
+
+    # Drops each (x, y, z) spawn point onto the floor under it
+    # Returns the snapped points and which of them have a floor at all (the rest are left as they were)
+    def snap_spawn_points(self, points, above=SM64_FLOOR_ABOVE):
+        snapped = np.array(points, np.float64).reshape(-1, 3)
+        heights, _ = self.floor_heights(snapped, above)
+        valid = ~np.isnan(heights)
+        snapped[valid, 1] = heights[valid]
+        return snapped, valid
+
+    # Adds a flat plane surface with a specified size, returns its handle
+    def make_flat_plane_surface_array(self, size):
+        surfaces = make_surface_array(2)
+        surfaces['surftype'] = COLLISION_TYPES['SURFACE_DEFAULT']
+        surfaces['terrain'] = COLLISION_TYPES['TERRAIN_GRASS']
+        surfaces['vertices'][0] = [[size, 0, -size], [-size, 0, -size], [-size, 0, size]]
+        surfaces['vertices'][1] = [[size, 0, size], [size, 0, -size], [-size, 0, size]]
+        return self.add_surfaces(surfaces)
+
+    # Creates a moving surface object from a surface array in its own local space, returns its id
+    # libsm64 keeps its own copy of the surfaces
+    def create_surface_object(self, surfaces, transform):
+        if not self.ready:
+            raise RuntimeError("Surface objects can't be created before the state has loaded")
+        surface_object = SM64SurfaceObject()
+        surface_object.transform = transform
+        surface_object.surfaceCount = len(surfaces)
+        surface_object.surfaces = surfaces_pointer(surfaces)
+        self.surface_object_count += 1
+        return self.sm64.sm64_surface_object_create(ct.byref(surface_object))
+
+    def move_surface_object(self, object_id, transform):
+        self.sm64.sm64_surface_object_move(object_id, ct.byref(transform))
+
+    def delete_surface_object(self, object_id):
+        self.surface_object_count -= 1
+        self.sm64.sm64_surface_object_delete(object_id)
+
+    # Reallocates the input/state arrays with room for capacity Marios, rebinding existing ones
+    def grow_slots(self, capacity):
+        inputs_buffer = (SM64MarioInputs * capacity)()
+        states_buffer = (SM64MarioState * capacity)()
+        if self.inputs_buffer != None:
+            ct.memmove(inputs_buffer, self.inputs_buffer, ct.sizeof(self.inputs_buffer))
+            ct.memmove(states_buffer, self.states_buffer, ct.sizeof(self.states_buffer))
+        self.inputs_buffer = inputs_buffer
+        self.states_buffer = states_buffer
+        self.slot_marios += [None] * (capacity - len(self.slot_marios))
+
+        self.inputs = np.frombuffer(self.inputs_buffer, SM64_INPUTS_DTYPE)
+        self.states = np.frombuffer(self.states_buffer, SM64_STATE_DTYPE)
+        slot_active = np.zeros(capacity, bool)
+        slot_active[:len(self.slot_marios)] = [mario != None for mario in self.slot_marios]
+        self.slot_active = slot_active
+
+        for slot, mario in enumerate(self.slot_marios):
+            if mario != None:
+                mario.use_buffers(self.inputs_buffer[slot], self.states_buffer[slot])
+
+    # Hands a Mario the first free input/state slot, growing the arrays if there's none
+    def allocate_slot(self, mario):
+        if None not in self.slot_marios:
+            self.grow_slots(len(self.slot_marios) * 2)
+        slot = self.slot_marios.index(None)
+        self.slot_marios[slot] = mario
+        self.slot_active[slot] = True
+        self.inputs[slot] = np.zeros((), SM64_INPUTS_DTYPE)
+        self.states[slot] = np.zeros((), SM64_STATE_DTYPE)
+        mario.use_buffers(self.inputs_buffer[slot], self.states_buffer[slot])
+        return slot
+
+    def free_slot(self, slot):
+        self.slot_marios[slot] = None
+        self.slot_active[slot] = False
+
+    def add_mario(self, mario):
+        self.marios.append(mario)
+
+    def remove_mario(self, mario):
+        if mario in self.marios:
+            self.marios.remove(mario)
+
+    # Runs sim ticks for the given Marios, returning the ones that crashed
+    def run_sim_ticks(self, marios, ticks):
+        crashed = []
+        for i in range(ticks):
+            for mario in marios:
+                if mario not in crashed and not mario.sim_tick():
+                    crashed.append(mario)
+        return crashed
+
+    def update_streamers(self):
+        if len(self.streamers) == 0:
+            return
+        stats = self.stats
+        if stats != None:
+            start = stats.begin('streaming')
+        for streamer in self.streamers:
+            streamer.update()
+        if stats != None:
+            stats.end('streaming', start)
+
+    # Steps every Mario by the given number of ticks, dropping any that crash
+    def tick(self, ticks=1):
+        stats = self.stats
+        if stats != None:
+            start = stats.begin('frame')
+        self.wait_for_sim()
+        self.update_streamers()
+        # on a threaded SM64State, Marios tick out of their sim copies
+        if self.threaded:
+            for mario in self.marios:
+                mario.stage_sim_inputs()
+        crashed = self.run_sim_ticks(self.marios, ticks)
+        if self.threaded:
+            for mario in self.marios:
+                if mario not in crashed:
+                    mario.swap_sim_buffers()
+        for mario in crashed:
+            self.remove_mario(mario)
+        if stats != None:
+            stats.end('frame', start)
+            stats.end_tick()
+
+class SM64SimMario:
+    # geometry=False skips keeping Mario's geometry around (libsm64 still writes it,
+    # into the state's shared scratch buffers)
+    def __init__(self, state, x, y, z, geometry=True):
+        self.mario_id = -1
+        if not self.init_sim(state, x, y, z, geometry):
+            return
+        self.sm64_state.add_mario(self)
+
+    # Sets up the buffers and creates Mario natively, returns False if he couldn't be
+    def init_sim(self, state, x, y, z, geometry=True):
+        self.mario_id = -1
+        self.tick_count = 0
+        # libsm64 isn't thread-safe, so nothing gets created while a threaded sim is mid-tick
+        state.wait_for_sim()
+
+        # libsm64 won't create him without ground under him, so don't set anything up for nothing
+        # (floors on surface objects aren't indexed, so with any around it's left to libsm64)
+        if state.surface_object_count == 0 and np.isnan(state.floor_heights([(x, y, z)])[0][0]):
+            print("Couldn't create this Mario! There's no solid ground at that position")
+            return False
+
+        self.sm64_state = state
+
+        # buffers
+        # what sim_tick reads and writes, separate copies when the sim has its own thread
+        # so it never touches what the main thread is reading or uploading
+        self.mario_geo = SM64MarioGeometryBuffers() if geometry else state.scratch_geo
+        if state.threaded:
+            self.sim_inputs = SM64MarioInputs()
+            self.sim_state = SM64MarioState()
+            self.sim_geo = SM64MarioGeometryBuffers() if geometry else state.scratch_geo
+        else:
+            self.sim_geo = self.mario_geo
+        # inputs and state are this Mario's slot in the state's arrays
+        self.mario_slot = state.allocate_slot(self)
+        # until his first tick writes it, his state says where he spawns, which is what streaming goes by
+        self.mario_state.posX, self.mario_state.posY, self.mario_state.posZ = x, y, z
+
+        # state-related things
+        self.mario_id = self.sm64_state.sm64.sm64_mario_create(int(x), int(y), int(z))
+        if self.mario_id == -1:
+            print("Couldn't create this Mario! Is there solid ground at that position?")
+            state.free_slot(self.mario_slot)
+            return False
+        return True
+
+    # Points Mario at input and state structs owned elsewhere (a slot in an array),
+    # which sim_tick then reads and writes directly, or via its own copies when threaded
+    def use_buffers(self, inputs, state):
+        self.mario_inputs = inputs
+        self.mario_state = state
+        if not self.sm64_state.threaded:
+            self.sim_inputs = inputs
+            self.sim_state = state
+
+    # Runs one native simulation tick
+    # Returns False if Mario can't be ticked anymore
+    def sim_tick(self):
+        stats = self.sm64_state.stats
+        if stats != None:
+            start = stats.begin('sim')
+        # tick him natively
+        try:
+            self.sm64_state.sm64.sm64_mario_tick(self.mario_id, ct.byref(self.sim_inputs), ct.byref(self.sim_state), ct.byref(self.sim_geo))
+        except:
+            print("Mario (id " + str(self.mario_id) + ") crashed or is untickable")
+            return False
+        finally:
+            if stats != None:
+                stats.end('sim', start, self.mario_id)
+
+        self.tick_count += 1
+        return True
+
+    # What SM64State's world scheduler calls on every Mario it ticks. Headless ones have nothing
+    # to draw, so they never upload and keep writing their geometry wherever init_sim put it
+    def needs_geometry(self, ticks):
+        return False
+
+    def lease_geometry(self):
+        pass
+
+    def release_geometry(self):
+        pass
+
+    def update_geometry(self, upload=True):
+        pass
+
+    def update_position(self):
+        pass
+
+    # Threaded sim only: hands the inputs set since last frame over to the sim copy
+    def stage_sim_inputs(self):
+        ct.memmove(ct.byref(self.sim_inputs), ct.byref(self.mario_inputs), ct.sizeof(SM64MarioInputs))
+
+    # Threaded sim only: the sim's latest results become the front buffers, and the old
+    # front geometry (already uploaded) is free for the sim to write next
+    # the state is copied rather than swapped, since the front one is Mario's slot in the state's arrays
+    def swap_sim_buffers(self):
+        ct.memmove(ct.byref(self.mario_state), ct.byref(self.sim_state), ct.sizeof(SM64MarioState))
+        self.mario_geo, self.sim_geo = self.sim_geo, self.mario_geo
+
+    # Stops ticking this Mario and frees him natively
+    def delete(self):
+        if self.mario_id == -1:
+            return
+        self.sm64_state.remove_mario(self)
+        self.sm64_state.sm64.sm64_mario_delete(self.mario_id)
+        self.sm64_state.free_slot(self.mario_slot)
+        if self.sm64_state.stats != None:
+            self.sm64_state.stats.forget_mario(self.mario_id)
+        self.mario_id = -1
+
+    def setPos(self, x, y, z):
+        if self.mario_id != -1:
+            self.mario_state.posX = x
+            self.mario_state.posY = y
+            self.mario_state.posZ = z
+
+    def setVel(self, x, y, z):
+        self.mario_state.velX = x
+        self.mario_state.velY = y
+        self.mario_state.velZ = z
+
+    def get_input_buttons(self, a: bool, b: bool, z: bool):
+        self.mario_inputs.buttonA = int(a)
+        self.mario_inputs.buttonB = int(b)
+        self.mario_inputs.buttonZ = int(z)
+
+    def get_input_stick(self, x: float, y: float):
+        self.mario_inputs.stickX = x
+        self.mario_inputs.stickY = y
+
+    def get_input_camera(self, x: float, y: float):
+        self.mario_inputs.camLookX = x
+        self.mario_inputs.camLookY = y
@@ -0,0 +1,205 @@
+import numpy as np
+from sm64_surfaces import *
+
+# Collision queries for libsm64-panda
+# A uniform grid over a surface array on the X/Z plane, like the game's own cell partitioning,
+# answering batches of floor, wall and ray queries in numpy without going through libsm64.
+# Plain numpy like sm64_surfaces. Units are libsm64's
+
+# width of a grid cell
+SM64_GRID_CELL_SIZE = 1024
+
+# how far above a point floors still count as under it, the game's find_floor checks from 78 above
+SM64_FLOOR_ABOVE = 78
+
+# how far from a point nearest_walls looks by default
+SM64_WALL_RADIUS = 100
+
+# wall normals are more horizontal than this, floors point up and ceilings down past it
+SM64_WALL_NORMAL_Y = 0.01
+
+# Packs grid cell coordinates into one sortable key
+def grid_cell_key(cx, cz):
+    return (cx + (1 << 20)) * (1 << 21) + (cz + (1 << 20))
+
+# Flattens per-row ranges [starts, starts + counts) into one index array,
+# along with the row each index came from
+def expand_ranges(starts, counts):
+    owner = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, np.repeat(starts, counts) + local
+
+# Distance from each point to the matching triangle, vectorized
+def point_triangle_distances(points, a, b, c, normals):
+    # inside the triangle's prism, it's the distance to its plane
+    offset = np.einsum('ij,ij->i', points - a, normals)
+    projected = points - offset[:, None] * normals
+    inside = np.ones(len(points), bool)
+    for start, end in ((a, b), (b, c), (c, a)):
+        inside &= np.einsum('ij,ij->i', np.cross(end - start, projected - start), normals) >= 0
+
+    # outside it, the distance to the nearest edge
+    edge_distance = np.full(len(points), np.inf)
+    for start, end in ((a, b), (b, c), (c, a)):
+        edge = end - start
+        length = np.maximum(np.einsum('ij,ij->i', edge, edge), 1e-12)
+        t = np.clip(np.einsum('ij,ij->i', points - start, edge) / length, 0, 1)
+        closest = start + t[:, None] * edge
+        edge_distance = np.minimum(edge_distance, np.linalg.norm(points - closest, axis=1))
+
+    return np.where(inside, np.abs(offset), edge_distance)
+
+# Per owner, the smallest value and the triangle it belongs to (inf and -1 for owners without any)
+def min_per_owner(count, owner, values, tris):
+    distances = np.full(count, np.inf)
+    surfaces = np.full(count, -1, np.int64)
+    if len(values) == 0:
+        return distances, surfaces
+    order = np.lexsort((values, owner))
+    first = np.unique(owner[order], return_index=True)[1]
+    best = order[first]
+    distances[owner[best]] = values[best]
+    surfaces[owner[best]] = tris[best]
+    return distances, surfaces
+
+class SM64SurfaceGrid:
+    # The grid keeps its own float copy of the surfaces, so later changes to the array don't affect it
+    def __init__(self, surfaces, cell_size=SM64_GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.vertices = surfaces['vertices'].astype(np.float64)
+        self.surftypes = surfaces['surftype'].copy()
+
+        normals = np.cross(self.vertices[:, 1] - self.vertices[:, 0], self.vertices[:, 2] - self.vertices[:, 0])
+        lengths = np.linalg.norm(normals, axis=1)
+        solid = lengths > 0
+        self.normals = normals / np.where(solid, lengths, 1)[:, None]
+        self.is_floor = solid & (self.normals[:, 1] > SM64_WALL_NORMAL_Y)
+        self.is_wall = solid & (np.abs(self.normals[:, 1]) <= SM64_WALL_NORMAL_Y)
+
+        # every triangle goes into every cell its X/Z bounds touch
+        xz = self.vertices[:, :, [0, 2]]
+        low = np.floor(xz.min(axis=1) / cell_size).astype(np.int64)
+        high = np.floor(xz.max(axis=1) / cell_size).astype(np.int64)
+        widths = high[:, 0] - low[:, 0] + 1
+        counts = widths * (high[:, 1] - low[:, 1] + 1)
+        tris, local = expand_ranges(np.zeros(len(counts), np.int64), counts)
+        keys = grid_cell_key(low[tris, 0] + local % widths[tris], low[tris, 1] + local // widths[tris])
+
+        # cell -> triangles, as sorted keys and ranges into cell_tris
+        order = np.argsort(keys, kind='stable')
+        self.cell_tris = tris[order]
+        self.cell_keys, self.cell_starts = np.unique(keys[order], return_index=True)
+        self.cell_counts = np.diff(np.r_[self.cell_starts, len(order)])
+
+    def point_cells(self, points):
+        return np.floor(points[:, [0, 2]] / self.cell_size).astype(np.int64)
+
+    # Every (point, triangle) pair for the triangles listed in each point's cell
+    def cell_candidates(self, cells):
+        if len(self.cell_keys) == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        keys = grid_cell_key(cells[:, 0], cells[:, 1])
+        index = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        found = self.cell_keys[index] == keys
+        starts = np.where(found, self.cell_starts[index], 0)
+        counts = np.where(found, self.cell_counts[index], 0)
+        owner, slots = expand_ranges(starts, counts)
+        return owner, self.cell_tris[slots]
+
+    # Height of the highest floor under each (x, y, z) point, counting ones up to above over it
+    # Returns the heights (NaN where there's no floor) and the floors' surface indices (-1)
+    def floor_heights(self, points, above=SM64_FLOOR_ABOVE):
+        points = np.asarray(points, np.float64).reshape(-1, 3)
+        owner, tris = self.cell_candidates(self.point_cells(points))
+        keep = self.is_floor[tris]
+        owner, tris = owner[keep], tris[keep]
+
+        # inside the triangle seen from above
+        v = self.vertices[tris]
+        x = points[owner, 0]
+        z = points[owner, 2]
+        inside = np.ones(len(tris), bool)
+        for i, j in ((0, 1), (1, 2), (2, 0)):
+            cross = (v[:, j, 0] - v[:, i, 0]) * (z - v[:, i, 2]) - (v[:, j, 2] - v[:, i, 2]) * (x - v[:, i, 0])
+            inside &= cross * self.normals[tris, 1] <= 0
+
+        n = self.normals[tris]
+        heights = v[:, 0, 1] - (n[:, 0] * (x - v[:, 0, 0]) + n[:, 2] * (z - v[:, 0, 2])) / n[:, 1]
+        keep = inside & (heights <= points[owner, 1] + above)
+
+        # highest first is lowest negated
+        depths, surfaces = min_per_owner(len(points), owner[keep], -heights[keep], tris[keep])
+        return np.where(surfaces != -1, -depths, np.nan), surfaces
+
+    # Nearest wall within radius of each point
+    # Returns the distances (inf where there's none) and the walls' surface indices (-1)
+    def nearest_walls(self, points, radius=SM64_WALL_RADIUS):
+        points = np.asarray(points, np.float64).reshape(-1, 3)
+        cells = self.point_cells(points)
+        reach = int(np.ceil(radius / self.cell_size))
+        owners = []
+        candidates = []
+        for dx in range(-reach, reach + 1):
+            for dz in range(-reach, reach + 1):
+                owner, tris = self.cell_candidates(cells + [dx, dz])
+                keep = self.is_wall[tris]
+                owners.append(owner[keep])
+                candidates.append(tris[keep])
+        owner = np.concatenate(owners)
+        tris = np.concatenate(candidates)
+
+        v = self.vertices[tris]
+        distances = point_triangle_distances(points[owner], v[:, 0], v[:, 1], v[:, 2], self.normals[tris])
+        keep = distances <= radius
+        return min_per_owner(len(points), owner[keep], distances[keep], tris[keep])
+
+    # Casts rays from origins along directions, up to max_distance, against every surface (both sides)
+    # Returns the hit distances (inf on a miss), surface indices (-1) and hit points
+    def raycast(self, origins, directions, max_distance):
+        origins = np.asarray(origins, np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, np.float64).reshape(-1, 3)
+        directions = directions / np.maximum(np.linalg.norm(directions, axis=1), 1e-12)[:, None]
+
+        # samples every half cell along each ray, plus the cells around them,
+        # covers every cell the ray passes through
+        spans = np.linalg.norm(directions[:, [0, 2]], axis=1) * max_distance
+        counts = np.ceil(spans / (self.cell_size / 2)).astype(np.int64) + 1
+        ray, step = expand_ranges(np.zeros(len(counts), np.int64), counts)
+        t = step / np.maximum(counts[ray] - 1, 1) * max_distance
+        cells = self.point_cells(origins[ray] + directions[ray] * t[:, None])
+        rays = []
+        keys = []
+        for dx in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                rays.append(ray)
+                keys.append(cells + [dx, dz])
+        ray = np.concatenate(rays)
+        cells = np.concatenate(keys)
+        pairs = np.unique(np.stack([ray, cells[:, 0], cells[:, 1]], axis=1), axis=0)
+        owner, tris = self.cell_candidates(pairs[:, 1:])
+        owner = pairs[owner, 0]
+        pairs = np.unique(np.stack([owner, tris], axis=1), axis=0)
+        owner, tris = pairs[:, 0], pairs[:, 1]
+
+        # Moller-Trumbore
+        v = self.vertices[tris]
+        o = origins[owner]
+        d = directions[owner]
+        e1 = v[:, 1] - v[:, 0]
+        e2 = v[:, 2] - v[:, 0]
+        p = np.cross(d, e2)
+        det = np.einsum('ij,ij->i', e1, p)
+        parallel = np.abs(det) < 1e-9
+        inv = 1 / np.where(parallel, 1, det)
+        s = o - v[:, 0]
+        u = np.einsum('ij,ij->i', s, p) * inv
+        q = np.cross(s, e1)
+        w = np.einsum('ij,ij->i', d, q) * inv
+        t = np.einsum('ij,ij->i', e2, q) * inv
+        keep = ~parallel & (u >= 0) & (w >= 0) & (u + w <= 1) & (t >= 0) & (t <= max_distance)
+
+        distances, surfaces = min_per_owner(len(origins), owner[keep], t[keep], tris[keep])
+        hit = np.isfinite(distances)
+        points = np.full((len(origins), 3), np.nan)
+        points[hit] = origins[hit] + directions[hit] * distances[hit, None]
+        return distances, surfaces, points
@@ -0,0 +1,122 @@
+import time
+from collections import deque
+import numpy as np
+
+# Hot path instrumentation for libsm64-panda
+# Each phase of a world tick is timed into a rolling window, overall and per Mario, and into a
+# PStats collector when there's a collector factory. States keep stats at None until
+# enable_stats is called, and every timed spot checks that first, so turned off it costs one
+# attribute lookup and comparison per phase. Plain python like sm64_sim, times are in seconds
+
+# every phase, in the order they're reported
+# frame: a whole world tick that ran sim ticks, the rest happen inside it
+# streaming/colliders: collision streaming and moving platform syncs
+# sim: one sm64_mario_tick, hash: geometry dedup hashing
+# vertices: copying a Mario's geometry into his vertex data, primitive: pointing his geom at it
+# batch: copying a Mario into his SM64MarioBatch slot, indices: rebuilding the batch's index buffer
+SM64_STAT_PHASES = ('frame', 'streaming', 'colliders', 'sim', 'hash', 'vertices', 'primitive', 'batch', 'indices')
+
+# Mean, percentiles and max of a window of samples
+def summarize_samples(samples):
+    if len(samples) == 0:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    values = np.fromiter(samples, np.float64, len(samples))
+    p50, p95, p99 = np.percentile(values, (50, 95, 99))
+    return {'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(values.max())}
+
+# Call count, total time and the latest durations of one phase
+class SM64PhaseTimes:
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.calls = 0
+        self.total = 0.0
+
+    def add(self, elapsed):
+        self.samples.append(elapsed)
+        self.calls += 1
+        self.total += elapsed
+
+    def summary(self):
+        result = summarize_samples(self.samples)
+        result['calls'] = self.calls
+        result['total'] = self.total
+        return result
+
+class SM64Stats:
+    # window is how many of the latest samples the rolling figures cover
+    # make_collector, when given, is called with a PStats collector name ("SM64" for frames,
+    # "SM64:<phase>" for the rest) and returns something with start() and stop(), like PStatCollector
+    def __init__(self, window=300, make_collector=None):
+        self.window = window
+        self.make_collector = make_collector
+        self.collectors = {}
+        self.reset()
+
+    # Clears every figure, keeping the collectors
+    def reset(self):
+        self.phases = {}
+        # mario id -> phase -> SM64PhaseTimes
+        self.marios = {}
+        # vertex and index bytes written into Panda's arrays, per frame that ran sim ticks
+        self.tick_bytes = deque(maxlen=self.window)
+        self.pending_bytes = 0
+        self.total_bytes = 0
+        self.ticks = 0
+
+    # Starts timing a phase, returns the start time to hand to end
+    def begin(self, phase):
+        if self.make_collector != None:
+            collector = self.collectors.get(phase)
+            if collector == None:
+                collector = self.make_collector('SM64' if phase == 'frame' else 'SM64:' + phase)
+                self.collectors[phase] = collector
+            collector.start()
+        return time.perf_counter()
+
+    # Stops timing a phase, recording it for the given Mario (by id) too if there's one
+    def end(self, phase, start, mario_id=None):
+        elapsed = time.perf_counter() - start
+        if self.make_collector != None:
+            self.collectors[phase].stop()
+
+        times = self.phases.get(phase)
+        if times == None:
+            times = self.phases[phase] = SM64PhaseTimes(self.window)
+        times.add(elapsed)
+
+        if mario_id != None:
+            phases = self.marios.setdefault(mario_id, {})
+            times = phases.get(phase)
+            if times == None:
+                times = phases[phase] = SM64PhaseTimes(self.window)
+            times.add(elapsed)
+
+    def add_bytes(self, count):
+        self.pending_bytes += count
+
+    # Closes the current frame's byte count
+    def end_tick(self):
+        self.tick_bytes.append(self.pending_bytes)
+        self.total_bytes += self.pending_bytes
+        self.pending_bytes = 0
+        self.ticks += 1
+
+    # Drops a deleted Mario's figures
+    def forget_mario(self, mario_id):
+        self.marios.pop(mario_id, None)
+
+    # Every phase's rolling mean, p50/p95/p99 and max over the window plus its overall call count
+    # and total, for one Mario (by id) or everything. Phases that never ran are left out.
+    # The overall summary also has bytes uploaded per frame, the same way
+    def summary(self, mario_id=None):
+        phases = self.phases if mario_id == None else self.marios.get(mario_id, {})
+        result = {}
+        for phase in SM64_STAT_PHASES:
+            if phase in phases:
+                result[phase] = phases[phase].summary()
+        if mario_id == None:
+            uploaded = summarize_samples(self.tick_bytes)
+            uploaded['ticks'] = self.ticks
+            uploaded['total'] = self.total_bytes
+            result['uploaded_bytes'] = uploaded
+        return result
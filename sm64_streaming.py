@@ -0,0 +1,108 @@
+import numpy as np
+from sm64_surfaces import *
+
+# Collision streaming for libsm64-panda
+# A big surface array is split into square chunks on the X/Z plane, and only the chunks
+# near a live Mario are kept in the state's static surfaces (see SM64SimState.add_surfaces).
+# Plain numpy like sm64_surfaces, so it works on headless states too. Units are libsm64's
+
+# Splits a surface array into chunk_size wide columns by triangle centroid
+# Returns the chunks (views into one sorted copy) and each chunk's actual
+# [min x, min z, max x, max z] bounds, which big triangles can stretch past its cell
+def split_surface_chunks(surfaces, chunk_size):
+    if len(surfaces) == 0:
+        return [], np.zeros((0, 4), np.float32)
+    vertices = surfaces['vertices'].astype(np.float32)
+    centroids = vertices.mean(axis=1)
+    cells = np.floor(centroids[:, [0, 2]] / chunk_size).astype(np.int64)
+    _, chunk_of = np.unique(cells, axis=0, return_inverse=True)
+    chunk_of = chunk_of.reshape(-1)
+
+    order = np.argsort(chunk_of, kind='stable')
+    sorted_surfaces = surfaces[order]
+    starts = np.flatnonzero(np.r_[True, np.diff(chunk_of[order]) != 0])
+    ends = np.r_[starts[1:], len(order)]
+
+    xz = vertices[order][:, :, [0, 2]]
+    mins = np.minimum.reduceat(xz.min(axis=1), starts)
+    maxs = np.maximum.reduceat(xz.max(axis=1), starts)
+    chunks = [sorted_surfaces[start:end] for start, end in zip(starts, ends)]
+    return chunks, np.concatenate([mins, maxs], axis=1)
+
+class SM64SurfaceStreamer:
+    # Chunks are loaded once a live Mario is within load_radius of them, and only unloaded
+    # when none is within unload_radius (1.5x load_radius unless given) so a Mario pacing
+    # along a border doesn't thrash. max_surfaces caps how many stay loaded, nearest first.
+    # surfaces is a surface array or the path of a cached one
+    def __init__(self, state, surfaces, chunk_size=4096, load_radius=4096, unload_radius=None, max_surfaces=None):
+        if isinstance(surfaces, str):
+            surfaces = load_surface_cache(surfaces)
+        self.state = state
+        self.load_radius = load_radius
+        self.unload_radius = unload_radius if unload_radius != None else load_radius * 1.5
+        self.max_surfaces = max_surfaces
+
+        self.chunks, self.bounds = split_surface_chunks(surfaces, chunk_size)
+        self.chunk_sizes = np.array([len(chunk) for chunk in self.chunks], np.int64)
+        # registry handle of each loaded chunk, None when it isn't
+        self.handles = [None] * len(self.chunks)
+        self.loaded = np.zeros(len(self.chunks), bool)
+
+        self.stats = {'chunks': len(self.chunks), 'loaded_chunks': 0, 'loaded_surfaces': 0,
+                      'loads': 0, 'unloads': 0, 'over_budget': 0}
+        state.streamers.append(self)
+
+    # Distance on the X/Z plane from every chunk's bounds to the nearest of the points
+    def chunk_distances(self, points):
+        if len(points) == 0:
+            return np.full(len(self.chunks), np.inf)
+        x = points[:, 0][None, :]
+        z = points[:, 2][None, :]
+        dx = np.maximum(np.maximum(self.bounds[:, 0:1] - x, x - self.bounds[:, 2:3]), 0)
+        dz = np.maximum(np.maximum(self.bounds[:, 1:2] - z, z - self.bounds[:, 3:4]), 0)
+        return np.sqrt(dx * dx + dz * dz).min(axis=1)
+
+    # Loads and unloads chunks around every live Mario plus any extra (x, y, z) points,
+    # like spawn points Marios are about to be created at. libsm64 reloads at most once
+    def update(self, extra_points=()):
+        state = self.state
+        points = np.stack([state.states['posX'], state.states['posY'], state.states['posZ']], axis=1)[state.slot_active]
+        if len(extra_points) > 0:
+            points = np.concatenate([points, np.asarray(extra_points, np.float32).reshape(-1, 3)])
+        distances = self.chunk_distances(points)
+
+        wanted = (distances <= self.load_radius) | (self.loaded & (distances <= self.unload_radius))
+        if self.max_surfaces != None and self.chunk_sizes[wanted].sum() > self.max_surfaces:
+            # nearest chunks first, whatever's past the budget stays out
+            order = np.flatnonzero(wanted)[np.argsort(distances[wanted], kind='stable')]
+            fits = np.cumsum(self.chunk_sizes[order]) <= self.max_surfaces
+            self.stats['over_budget'] += int((~fits).sum())
+            wanted[:] = False
+            wanted[order[fits]] = True
+
+        to_unload = np.flatnonzero(self.loaded & ~wanted)
+        to_load = np.flatnonzero(wanted & ~self.loaded)
+        if len(to_unload) == 0 and len(to_load) == 0:
+            return
+
+        for chunk in to_unload:
+            state.remove_surfaces(self.handles[chunk], reload=False)
+            self.handles[chunk] = None
+        for chunk in to_load:
+            self.handles[chunk] = state.add_surfaces(self.chunks[chunk], reload=False)
+        state.reload_surfaces()
+        self.loaded = wanted
+
+        self.stats['loads'] += len(to_load)
+        self.stats['unloads'] += len(to_unload)
+        self.stats['loaded_chunks'] = int(wanted.sum())
+        self.stats['loaded_surfaces'] = int(self.chunk_sizes[wanted].sum())
+
+    # Unloads every chunk and stops streaming
+    def close(self):
+        for chunk in np.flatnonzero(self.loaded):
+            self.state.remove_surfaces(self.handles[chunk], reload=False)
+            self.handles[chunk] = None
+        self.state.reload_surfaces()
+        self.loaded[:] = False
+        self.state.streamers.remove(self)
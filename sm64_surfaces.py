@@ -0,0 +1,225 @@
+import ctypes as ct
+import os
+import numpy as np
+from from_blender import *
+
+# SM64Surface arrays for libsm64-panda
+# Everything here is plain numpy, so it's usable without Panda (see sm64_sim)
+
+# TODO(patchmixolydic): needs a better name
+SM64_BOUNDS = 0x7FFF
+
+# numpy layout of SM64Surface, so whole surface arrays can be built without a struct per triangle
+SM64_SURFACE_DTYPE = np.dtype([
+    ('surftype', np.int16),
+    ('force', np.int16),
+    ('terrain', np.uint16),
+    ('vertices', np.int16, (3, 3)),
+])
+
+# Allocates a zeroed surface array
+def make_surface_array(count):
+    return np.zeros(count, SM64_SURFACE_DTYPE)
+
+# Pointer to a surface array, for handing it to libsm64 without copying
+def surfaces_pointer(surfaces):
+    return surfaces.ctypes.data_as(ct.POINTER(SM64Surface))
+
+# Memory-maps a cached surface array, or returns None if it's missing or unusable
+def load_surface_cache(path):
+    try:
+        surfaces = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if surfaces.dtype != SM64_SURFACE_DTYPE:
+        return None
+    return surfaces
+
+# Writes a surface array to the cache, through a temporary file so readers never see half of one
+def save_surface_cache(surfaces, path):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            np.save(file, surfaces)
+        os.replace(temp_path, path)
+    except OSError:
+        print("Couldn't write the surface cache to " + path)
+
+# Rotates each triangle so its smallest vertex comes first, keeping the winding
+# Two triangles covering the same face the same way then compare equal
+def canonical_triangles(verts):
+    keys = vertex_keys(verts)
+    first = np.argmin(keys, axis=1)
+    order = (first[:, None] + np.arange(3)) % 3
+    return np.take_along_axis(verts, order[:, :, None], axis=1)
+
+# Packs int16 vertices into single int64 keys, shape (..., 3) -> (...)
+def vertex_keys(verts):
+    v = verts.astype(np.int64) + 0x8000
+    return (v[..., 0] << 32) | (v[..., 1] << 16) | v[..., 2]
+
+# Plane of each triangle in exact integers: its normal divided down by the gcd of its
+# components, and its offset along that normal. Coplanar, same-facing triangles match exactly
+def triangle_planes(verts):
+    v = verts.astype(np.int64)
+    normals = np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0])
+    divisor = np.gcd.reduce(np.abs(normals), axis=1)
+    normals //= np.maximum(divisor, 1)[:, None]
+    offsets = np.einsum('ij,ij->i', normals, v[:, 0])
+    return normals, offsets
+
+# Directed edges of a polygon given as a list of vertex tuples in winding order
+def polygon_edges(polygon):
+    return [(polygon[k], polygon[(k + 1) % len(polygon)]) for k in range(len(polygon))]
+
+def edge_cross(a, b, c):
+    e1 = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+    e2 = (c[0] - b[0], c[1] - b[1], c[2] - b[2])
+    return (e1[1] * e2[2] - e1[2] * e2[1], e1[2] * e2[0] - e1[0] * e2[2], e1[0] * e2[1] - e1[1] * e2[0])
+
+# Union of two polygons in the plane with the given normal, if it's one convex polygon no more than
+# max_size across on any axis, otherwise None. Vertices in the middle of straight edges are kept,
+# so edges still line up with the neighbours' until the very end
+def merge_convex_polygons(first, second, normal, max_size):
+    # edges the two share cancel out, what's left has to be a single loop
+    edges = {}
+    for edge in polygon_edges(first) + polygon_edges(second):
+        if (edge[1], edge[0]) in edges:
+            del edges[(edge[1], edge[0])]
+        else:
+            edges[edge] = True
+    following = {}
+    for a, b in edges:
+        if a in following:
+            return None
+        following[a] = b
+
+    start = next(iter(following))
+    merged = [start]
+    vertex = following[start]
+    while vertex != start:
+        merged.append(vertex)
+        vertex = following.get(vertex)
+        if vertex == None or len(merged) > len(following):
+            return None
+    if len(merged) != len(following):
+        return None
+
+    for axis in range(3):
+        coords = [vertex[axis] for vertex in merged]
+        if max(coords) - min(coords) > max_size:
+            return None
+
+    # every corner turns the same way as the plane, or goes straight on
+    for k in range(len(merged)):
+        a, b, c = merged[k - 1], merged[k], merged[(k + 1) % len(merged)]
+        cross = edge_cross(a, b, c)
+        turn = cross[0] * normal[0] + cross[1] * normal[1] + cross[2] * normal[2]
+        if turn < 0:
+            return None
+        if cross == (0, 0, 0) and (b[0] - a[0]) * (c[0] - b[0]) + (b[1] - a[1]) * (c[1] - b[1]) + (b[2] - a[2]) * (c[2] - b[2]) < 0:
+            return None
+    return merged
+
+# Fans a convex polygon into triangles, skipping the vertices in the middle of straight edges
+def triangulate_convex_polygon(polygon):
+    corners = [polygon[k] for k in range(len(polygon))
+               if edge_cross(polygon[k - 1], polygon[k], polygon[(k + 1) % len(polygon)]) != (0, 0, 0)]
+    return [(corners[0], corners[k], corners[k + 1]) for k in range(1, len(corners) - 1)]
+
+# Greedily merges a group of coplanar, same-facing triangles into convex polygons and
+# re-triangulates them, returns the new triangles as an (n, 3, 3) array
+def merge_coplanar_triangles(triangles, normal, max_size):
+    normal = tuple(int(component) for component in normal)
+    polygons = {n: [tuple(int(c) for c in vertex) for vertex in triangle] for n, triangle in enumerate(triangles)}
+    # directed edge -> polygon, None where more than one polygon has it (overlaps)
+    owners = {}
+    def add_edges(n):
+        for edge in polygon_edges(polygons[n]):
+            owners[edge] = n if edge not in owners else None
+    def remove_edges(n):
+        for edge in polygon_edges(polygons[n]):
+            if owners.get(edge) == n:
+                del owners[edge]
+    for n in polygons:
+        add_edges(n)
+
+    # in rounds where each polygon merges at most once, so sizes grow evenly
+    # instead of one polygon slowly swallowing everything around it
+    merging = True
+    while merging:
+        merging = False
+        used = set()
+        for n in list(polygons):
+            if n in used or n not in polygons:
+                continue
+            neighbours = []
+            for a, b in polygon_edges(polygons[n]):
+                other = owners.get((b, a))
+                if other != None and other != n and other not in used and other not in neighbours:
+                    neighbours.append(other)
+            for other in neighbours:
+                merged = merge_convex_polygons(polygons[n], polygons[other], normal, max_size)
+                if merged == None:
+                    continue
+                remove_edges(n)
+                remove_edges(other)
+                del polygons[other]
+                polygons[n] = merged
+                add_edges(n)
+                used.add(n)
+                used.add(other)
+                merging = True
+                break
+
+    result = [triangle for polygon in polygons.values() for triangle in triangulate_convex_polygon(polygon)]
+    return np.array(result, np.int64).reshape(-1, 3, 3)
+
+# Optional cleanup pass for quantized surfaces before they're loaded
+# Drops zero-area and duplicate triangles, then merges every connected patch of coplanar,
+# same-facing triangles (same surftype/terrain/force) into as few convex polygons as it can
+# and re-triangulates those, which collapses tessellated floors and walls, fans and strips.
+# No merged surface spans more than max_size on any axis.
+# Returns the new array and before/after counts
+def optimize_surfaces(surfaces, max_size=SM64_BOUNDS):
+    stats = {'before': len(surfaces)}
+
+    verts = surfaces['vertices'].astype(np.int64)
+    normals = np.cross(verts[:, 1] - verts[:, 0], verts[:, 2] - verts[:, 0])
+    surfaces = surfaces[np.any(normals, axis=1)]
+    stats['degenerate'] = stats['before'] - len(surfaces)
+
+    canonical = canonical_triangles(surfaces['vertices'])
+    _, unique = np.unique(canonical.reshape(len(canonical), 9), axis=0, return_index=True)
+    count = len(surfaces)
+    surfaces = surfaces[np.sort(unique)]
+    stats['duplicate'] = count - len(surfaces)
+
+    # groups of triangles sharing a plane, facing and type
+    normals, offsets = triangle_planes(surfaces['vertices'])
+    keys = np.concatenate([surfaces['surftype'][:, None], surfaces['terrain'][:, None], surfaces['force'][:, None],
+                           normals, offsets[:, None]], axis=1).astype(np.int64)
+    if len(keys) > 0:
+        _, group_of, group_sizes = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        group_of = group_of.reshape(-1)
+    else:
+        group_of = group_sizes = np.zeros(0, np.int64)
+
+    # lone triangles pass straight through
+    single = group_sizes[group_of] == 1
+    parts = [surfaces[single]]
+    order = np.argsort(group_of, kind='stable')
+    order = order[~single[order]]
+    starts = np.flatnonzero(np.r_[True, np.diff(group_of[order]) != 0]) if len(order) > 0 else []
+    for start, end in zip(starts, np.r_[starts[1:], len(order)] if len(order) > 0 else []):
+        members = order[start:end]
+        triangles = merge_coplanar_triangles(surfaces['vertices'][members], normals[members[0]], max_size)
+        part = np.repeat(surfaces[members[:1]], len(triangles))
+        part['vertices'] = triangles
+        parts.append(part)
+    merged = np.concatenate(parts)
+    stats['merged'] = len(surfaces) - len(merged)
+
+    stats['after'] = len(merged)
+    return merged, stats
@@ -0,0 +1,25 @@
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+
+# the modules live at the top of the repo, not in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sm64_sim import library_name
+
+# Builds tests/fake_libsm64.c as libsm64 next to an empty stand-in ROM
+# Returns (dll_directory, dll_name_stub, rom_path), like the states and farm take
+@pytest.fixture(scope='session')
+def fake_sm64(tmp_path_factory):
+    compiler = shutil.which('cc')
+    if compiler == None:
+        pytest.skip("no C compiler to build the fake libsm64 with")
+    directory = tmp_path_factory.mktemp('fake_sm64')
+    source = os.path.join(ROOT, 'tests', 'fake_libsm64.c')
+    subprocess.run([compiler, '-shared', '-fPIC', '-o', str(directory / library_name('sm64')), source], check=True)
+    rom_path = directory / 'sm64.z64'
+    rom_path.write_bytes(bytes(64))
+    return str(directory), 'sm64', str(rom_path)
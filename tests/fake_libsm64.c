@@ -0,0 +1,51 @@
+// Stand-in for libsm64, built by conftest.py so the tests run without a ROM or the real library
+// Marios only walk: every tick moves one by its stick input along X/Z,
+// and creating one fails until some static surfaces are loaded
+#include <stdint.h>
+#include <string.h>
+
+typedef struct { int16_t type, force; uint16_t terrain; int16_t vertices[3][3]; } Surface;
+typedef struct { float camLookX, camLookZ, stickX, stickY; uint8_t buttonA, buttonB, buttonZ; } Inputs;
+typedef struct { float position[3], velocity[3], faceAngle; int16_t health; } State;
+typedef struct { float *position, *normal, *color, *uv; uint16_t numTrianglesUsed; } Geometry;
+typedef struct { float position[3], eulerRotation[3]; } ObjectTransform;
+typedef struct { ObjectTransform transform; uint32_t surfaceCount; Surface *surfaces; } SurfaceObject;
+
+#define MAX_MARIOS 64
+
+static uint32_t surface_count = 0;
+static float positions[MAX_MARIOS][3];
+static int used[MAX_MARIOS];
+static uint32_t next_object = 0;
+
+void sm64_global_init(const uint8_t *rom, uint8_t *texture, void *debug_print) {}
+void sm64_global_terminate(void) {}
+
+void sm64_static_surfaces_load(const Surface *surfaces, uint32_t count) { surface_count = count; }
+
+int32_t sm64_mario_create(int16_t x, int16_t y, int16_t z) {
+    if (surface_count == 0) return -1;
+    for (int i = 0; i < MAX_MARIOS; i++) {
+        if (!used[i]) {
+            used[i] = 1;
+            positions[i][0] = x; positions[i][1] = y; positions[i][2] = z;
+            return i;
+        }
+    }
+    return -1;
+}
+
+void sm64_mario_tick(uint32_t id, const Inputs *inputs, State *state, Geometry *geometry) {
+    positions[id][0] += inputs->stickX;
+    positions[id][2] += inputs->stickY;
+    memcpy(state->position, positions[id], sizeof(positions[id]));
+    state->health = 0x880;
+    geometry->numTrianglesUsed = 1;
+    for (int i = 0; i < 9; i++) geometry->position[i] = positions[id][i % 3];
+}
+
+void sm64_mario_delete(int32_t id) { used[id] = 0; }
+
+uint32_t sm64_surface_object_create(const SurfaceObject *object) { return next_object++; }
+void sm64_surface_object_move(uint32_t id, const ObjectTransform *transform) {}
+void sm64_surface_object_delete(uint32_t id) {}
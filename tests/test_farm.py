@@ -0,0 +1,36 @@
+import threading
+import pytest
+from sm64_farm import *
+
+def flat_plane(size):
+    surfaces = make_surface_array(2)
+    surfaces['vertices'][0] = [[size, 0, -size], [-size, 0, -size], [-size, 0, size]]
+    surfaces['vertices'][1] = [[size, 0, size], [size, 0, -size], [-size, 0, size]]
+    return surfaces
+
+SPAWNS = [(0, 0, 0), (100, 0, 0), (200, 0, 0)]
+
+def test_farm_step_reset_close(fake_sm64):
+    farm = SM64Farm(2, 3, *fake_sm64, flat_plane(1000), SPAWNS, timeout=60)
+    try:
+        assert farm.alive.tolist() == [[1, 1, 1], [1, 1, 1]]
+        farm.inputs['stickX'][0] = 5
+        farm.inputs['stickX'][1] = 2
+        farm.step(4)
+        farm.step()
+        assert farm.states['posX'].tolist() == [[25, 125, 225], [10, 110, 210]]
+
+        farm.reset()
+        # nothing from the last run is left over
+        assert (farm.states['posX'] == 0).all()
+        farm.step()
+        assert farm.states['posX'].tolist() == [[5, 105, 205], [2, 102, 202]]
+    finally:
+        farm.close()
+    assert farm.workers == None and farm.states == None
+    # closing again does nothing
+    farm.close()
+
+def test_farm_that_fails_to_start(fake_sm64, tmp_path):
+    with pytest.raises(threading.BrokenBarrierError):
+        SM64Farm(2, 1, fake_sm64[0], fake_sm64[1], str(tmp_path / 'missing.z64'), flat_plane(1000), SPAWNS[:1], timeout=60)
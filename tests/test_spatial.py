@@ -0,0 +1,92 @@
+import numpy as np
+from sm64_sim import *
+from sm64_spatial import *
+
+# Square floor from (x, z) to (x + size, z + size) at height y, facing up
+def floor(x, z, size, y):
+    surfaces = make_surface_array(2)
+    surfaces['vertices'][0] = [[x, y, z], [x, y, z + size], [x + size, y, z]]
+    surfaces['vertices'][1] = [[x + size, y, z], [x, y, z + size], [x + size, y, z + size]]
+    return surfaces
+
+# Wall along z from z0 to z1 at x, 300 high, facing +x
+def wall(x, z0, z1):
+    surfaces = make_surface_array(2)
+    surfaces['vertices'][0] = [[x, 0, z0], [x, 0, z1], [x, 300, z0]]
+    surfaces['vertices'][1] = [[x, 300, z0], [x, 0, z1], [x, 300, z1]]
+    return surfaces
+
+def test_floor_heights():
+    grid = SM64SurfaceGrid(np.concatenate([floor(-2000, -2000, 4000, 0), floor(0, 0, 500, 200)]))
+    heights, surfaces = grid.floor_heights([(-100, 50, -100), (100, 500, 100), (100, 150, 100), (5000, 0, 0)])
+    assert heights[:3].tolist() == [0, 200, 200]
+    assert surfaces[0] in (0, 1) and surfaces[1] in (2, 3)
+    assert np.isnan(heights[3]) and surfaces[3] == -1
+
+def test_floor_heights_only_reach_up_so_far():
+    grid = SM64SurfaceGrid(floor(0, 0, 500, 100))
+    heights, _ = grid.floor_heights([(100, 100 - SM64_FLOOR_ABOVE, 100), (100, 99 - SM64_FLOOR_ABOVE, 100)])
+    assert heights[0] == 100
+    assert np.isnan(heights[1])
+
+def test_nearest_walls():
+    grid = SM64SurfaceGrid(np.concatenate([floor(-2000, -2000, 4000, 0), wall(1000, -500, 500)]))
+    distances, surfaces = grid.nearest_walls([(950, 100, 0), (1030, 100, 560), (0, 100, 0)], radius=100)
+    assert np.allclose(distances[:2], [50, np.hypot(30, 60)])
+    assert surfaces[0] in (2, 3)
+    assert distances[2] == np.inf and surfaces[2] == -1
+
+def test_raycast():
+    grid = SM64SurfaceGrid(np.concatenate([floor(-2000, -2000, 4000, 0), wall(1000, -500, 500)]))
+    distances, surfaces, points = grid.raycast([(0, 100, 0), (0, 100, 0), (0, 100, 0)],
+                                               [(0, -1, 0), (1, 0, 0), (0, 1, 0)], 5000)
+    assert np.allclose(distances[:2], [100, 1000])
+    assert np.allclose(points[:2], [(0, 0, 0), (1000, 100, 0)])
+    assert surfaces[1] in (2, 3)
+    assert distances[2] == np.inf and surfaces[2] == -1 and np.isnan(points[2]).all()
+
+# A state's queries go through a grid per surface group, they should match one grid over all of them
+def test_state_queries_match_one_grid(fake_sm64):
+    state = SM64SimState(*fake_sm64, load=False)
+    rng = np.random.default_rng(0)
+    handles = []
+    for x in range(-3000, 3000, 1500):
+        for z in range(-3000, 3000, 1500):
+            handles.append(state.add_surfaces(floor(x, z, 1500, int(rng.integers(-50, 50))), reload=False))
+    state.add_surfaces(wall(200, -3000, 3000), reload=False)
+    state.add_surfaces(floor(-500, -500, 1000, 150), reload=False)
+    state.remove_surfaces(handles[5], reload=False)
+    state.reload_surfaces()
+    grid = SM64SurfaceGrid(state.static_surfaces)
+
+    points = np.stack([rng.uniform(-3500, 3500, 500), rng.uniform(-100, 300, 500), rng.uniform(-3500, 3500, 500)], axis=1)
+    heights, surfaces = state.floor_heights(points)
+    expected_heights, expected_surfaces = grid.floor_heights(points)
+    assert np.array_equal(heights, expected_heights, equal_nan=True)
+    assert np.array_equal(surfaces, expected_surfaces)
+
+    distances, surfaces = state.nearest_walls(points, 300)
+    expected_distances, expected_surfaces = grid.nearest_walls(points, 300)
+    assert np.allclose(distances, expected_distances)
+    assert np.array_equal(surfaces, expected_surfaces)
+
+    directions = rng.normal(size=(500, 3))
+    distances, surfaces, hits = state.raycast(points, directions, 2000)
+    expected_distances, expected_surfaces, expected_hits = grid.raycast(points, directions, 2000)
+    assert np.allclose(distances, expected_distances)
+    assert np.allclose(hits, expected_hits, equal_nan=True)
+
+# Adding or removing a group keeps the other groups' grids
+def test_state_grids_outlive_other_groups(fake_sm64):
+    state = SM64SimState(*fake_sm64, load=False)
+    first = state.add_surfaces(floor(0, 0, 1000, 0))
+    state.floor_heights([(500, 0, 500)])
+    grid = state.group_grids[first]
+    second = state.add_surfaces(floor(5000, 0, 1000, 0))
+    heights, surfaces = state.floor_heights([(500, 0, 500), (5500, 0, 500)])
+    assert state.group_grids[first] is grid
+    assert heights.tolist() == [0, 0] and surfaces[1] in (2, 3)
+    state.remove_surfaces(first)
+    assert second in state.group_grids and first not in state.group_grids
+    heights, surfaces = state.floor_heights([(500, 0, 500), (5500, 0, 500)])
+    assert np.isnan(heights[0]) and surfaces[1] in (0, 1)
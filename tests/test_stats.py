@@ -0,0 +1,61 @@
+import numpy as np
+from sm64_stats import *
+
+def test_summarize_samples():
+    summary = summarize_samples(range(1, 101))
+    assert summary['mean'] == 50.5
+    assert summary['max'] == 100
+    assert np.isclose(summary['p50'], 50.5)
+    assert np.isclose(summary['p95'], 95.05)
+    assert np.isclose(summary['p99'], 99.01)
+
+def test_summarize_no_samples():
+    assert summarize_samples([]) == {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+
+def test_phase_window():
+    times = SM64PhaseTimes(3)
+    for elapsed in (10.0, 1.0, 2.0, 3.0):
+        times.add(elapsed)
+    summary = times.summary()
+    # the rolling figures only cover the latest three, the totals everything
+    assert summary['max'] == 3.0 and summary['p50'] == 2.0
+    assert summary['calls'] == 4 and summary['total'] == 16.0
+
+class FakeCollector:
+    def __init__(self, name):
+        self.name = name
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+def test_stats_summary():
+    collectors = []
+    def make_collector(name):
+        collectors.append(FakeCollector(name))
+        return collectors[-1]
+    stats = SM64Stats(window=10, make_collector=make_collector)
+
+    stats.end('sim', stats.begin('sim'), mario_id=3)
+    start = stats.begin('frame')
+    assert collectors[-1].running
+    stats.end('frame', start)
+    stats.add_bytes(100)
+    stats.add_bytes(20)
+    stats.end_tick()
+
+    summary = stats.summary()
+    assert list(summary) == ['frame', 'sim', 'uploaded_bytes']
+    assert summary['sim']['calls'] == 1
+    assert summary['uploaded_bytes']['total'] == 120 and summary['uploaded_bytes']['ticks'] == 1
+    assert sorted(collector.name for collector in collectors) == ['SM64', 'SM64:sim']
+    assert not any(collector.running for collector in collectors)
+
+    assert list(stats.summary(3)) == ['sim']
+    stats.forget_mario(3)
+    assert stats.summary(3) == {}
+    stats.reset()
+    assert stats.summary()['uploaded_bytes']['ticks'] == 0
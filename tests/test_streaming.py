@@ -0,0 +1,84 @@
+import numpy as np
+from sm64_sim import *
+from sm64_streaming import *
+
+# A row of count 1000 wide floor tiles along x, two triangles each
+def floor_row(count, z=0):
+    surfaces = make_surface_array(2 * count)
+    for i in range(count):
+        x0, x1 = i * 1000, i * 1000 + 1000
+        surfaces['vertices'][2 * i] = [[x0, 0, z], [x0, 0, z + 1000], [x1, 0, z]]
+        surfaces['vertices'][2 * i + 1] = [[x1, 0, z], [x0, 0, z + 1000], [x1, 0, z + 1000]]
+    return surfaces
+
+# A state with one live Mario slot, without libsm64 loaded
+def make_state(fake_sm64):
+    state = SM64SimState(*fake_sm64, load=False)
+    state.slot_active[0] = True
+    return state
+
+def move(state, x):
+    state.states['posX'][0] = x
+    state.states['posZ'][0] = 500
+
+def loaded_chunks(streamer):
+    return np.flatnonzero(streamer.loaded).tolist()
+
+def test_split_surface_chunks():
+    chunks, bounds = split_surface_chunks(floor_row(4), 2000)
+    assert [len(chunk) for chunk in chunks] == [4, 4]
+    assert bounds.tolist() == [[0, 0, 2000, 1000], [2000, 0, 4000, 1000]]
+
+def test_streaming_loads_near_and_unloads_far(fake_sm64):
+    state = make_state(fake_sm64)
+    streamer = SM64SurfaceStreamer(state, floor_row(10), chunk_size=1000, load_radius=1000)
+    assert streamer.unload_radius == 1500
+
+    move(state, 500)
+    streamer.update()
+    assert loaded_chunks(streamer) == [0, 1]
+    assert state.surface_count == 4
+
+    # the first chunk is past the load radius but within the unload radius, so it stays
+    move(state, 2300)
+    streamer.update()
+    assert loaded_chunks(streamer) == [0, 1, 2, 3]
+
+    move(state, 2600)
+    streamer.update()
+    assert loaded_chunks(streamer) == [1, 2, 3]
+    assert state.surface_count == 6
+    assert streamer.stats['loads'] == 4 and streamer.stats['unloads'] == 1
+
+    streamer.close()
+    assert state.surface_count == 0
+    assert streamer not in state.streamers
+
+def test_streaming_extra_points(fake_sm64):
+    state = make_state(fake_sm64)
+    state.slot_active[0] = False
+    streamer = SM64SurfaceStreamer(state, floor_row(10), chunk_size=1000, load_radius=0)
+    streamer.update([(7500, 0, 500)])
+    assert loaded_chunks(streamer) == [7]
+
+def test_streaming_keeps_to_max_surfaces(fake_sm64):
+    state = make_state(fake_sm64)
+    streamer = SM64SurfaceStreamer(state, floor_row(10), chunk_size=1000, load_radius=1000, max_surfaces=4)
+    move(state, 2300)
+    streamer.update()
+    # nearest first: the chunk he's on, then the one 300 away
+    assert loaded_chunks(streamer) == [1, 2]
+    assert streamer.stats['over_budget'] == 1
+    assert state.surface_count == 4
+
+# A new Mario's slot says where he spawned, so streaming goes by that before his first tick
+def test_streaming_follows_new_marios(fake_sm64):
+    state = SM64SimState(*fake_sm64)
+    state.load_static_surfaces(floor_row(10, z=-500))
+    streamer = SM64SurfaceStreamer(state, floor_row(10), chunk_size=1000, load_radius=0)
+    mario = SM64SimMario(state, 6500, 0, 0, geometry=False)
+    assert mario.mario_id != -1
+    assert (mario.mario_state.posX, mario.mario_state.posY, mario.mario_state.posZ) == (6500, 0, 0)
+    state.update_streamers()
+    assert loaded_chunks(streamer) == [6]
+    mario.delete()
@@ -0,0 +1,92 @@
+import numpy as np
+from sm64_surfaces import *
+
+# Flat n x n grid of size-wide quads at height y, two triangles each, facing up
+def flat_grid(n, size=100, y=0, offset=0):
+    surfaces = make_surface_array(2 * n * n)
+    index = 0
+    for i in range(n):
+        for j in range(n):
+            x0, z0 = offset + i * size, offset + j * size
+            x1, z1 = x0 + size, z0 + size
+            surfaces['vertices'][index] = [[x0, y, z0], [x0, y, z1], [x1, y, z0]]
+            surfaces['vertices'][index + 1] = [[x1, y, z0], [x0, y, z1], [x1, y, z1]]
+            index += 2
+    return surfaces
+
+# Total area covered, from the cross products
+def total_area(surfaces):
+    v = surfaces['vertices'].astype(np.float64)
+    return np.linalg.norm(np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0]), axis=1).sum() / 2
+
+def upward(surfaces):
+    v = surfaces['vertices'].astype(np.int64)
+    return np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0])[:, 1] > 0
+
+def test_optimize_collapses_flat_grid():
+    surfaces = flat_grid(50)
+    merged, stats = optimize_surfaces(surfaces)
+    assert stats['before'] == 5000
+    assert stats['after'] == len(merged)
+    assert len(merged) < 10
+    assert total_area(merged) == total_area(surfaces)
+    assert upward(merged).all()
+
+def test_optimize_keeps_spans_within_max_size():
+    surfaces = flat_grid(20, offset=-1000)
+    merged, _ = optimize_surfaces(surfaces, max_size=500)
+    spans = merged['vertices'].max(axis=1) - merged['vertices'].min(axis=1)
+    assert (spans <= 500).all()
+    assert len(merged) < len(surfaces)
+    assert total_area(merged) == total_area(surfaces)
+
+def test_optimize_keeps_concave_shapes():
+    # an L of three quads can't be one convex polygon, but it's still fewer triangles
+    surfaces = flat_grid(2)[:6]
+    merged, _ = optimize_surfaces(surfaces)
+    assert len(merged) == 4
+    assert total_area(merged) == total_area(surfaces)
+
+def test_optimize_separates_surface_types():
+    surfaces = flat_grid(4)
+    surfaces['surftype'][:16] = COLLISION_TYPES['SURFACE_DEFAULT']
+    surfaces['surftype'][16:] = COLLISION_TYPES['SURFACE_BURNING']
+    merged, _ = optimize_surfaces(surfaces)
+    for surftype in (COLLISION_TYPES['SURFACE_DEFAULT'], COLLISION_TYPES['SURFACE_BURNING']):
+        assert total_area(merged[merged['surftype'] == surftype]) == total_area(surfaces[surfaces['surftype'] == surftype])
+
+def test_optimize_drops_degenerate_and_duplicate_triangles():
+    surfaces = make_surface_array(4)
+    surfaces['vertices'][0] = [[0, 0, 0], [0, 0, 100], [100, 0, 0]]
+    # the same triangle starting from another vertex
+    surfaces['vertices'][1] = [[0, 0, 100], [100, 0, 0], [0, 0, 0]]
+    surfaces['vertices'][2] = [[0, 0, 0], [50, 0, 0], [100, 0, 0]]
+    surfaces['vertices'][3] = [[0, 0, 0], [0, 100, 0], [0, 0, 100]]
+    merged, stats = optimize_surfaces(surfaces)
+    assert stats['degenerate'] == 1
+    assert stats['duplicate'] == 1
+    assert len(merged) == 2
+
+def test_canonical_triangles_rotate_to_the_smallest_vertex():
+    verts = np.array([[[5, 0, 0], [0, 0, 0], [0, 0, 5]],
+                      [[0, 0, 0], [0, 0, 5], [5, 0, 0]],
+                      [[0, 0, 5], [5, 0, 0], [0, 0, 0]]], np.int16)
+    canonical = canonical_triangles(verts)
+    assert (canonical == canonical[1]).all()
+    # the reverse winding is a different face
+    assert not (canonical_triangles(verts[:, ::-1]) == canonical).all()
+
+def test_surface_cache_round_trip(tmp_path):
+    surfaces = flat_grid(3)
+    surfaces['terrain'] = COLLISION_TYPES['TERRAIN_SNOW']
+    path = str(tmp_path / 'cache' / 'surfaces.npy')
+    save_surface_cache(surfaces, path)
+    loaded = load_surface_cache(path)
+    assert loaded.dtype == SM64_SURFACE_DTYPE
+    assert (loaded == surfaces).all()
+
+def test_surface_cache_rejects_other_arrays(tmp_path):
+    path = str(tmp_path / 'other.npy')
+    np.save(path, np.zeros(3))
+    assert load_surface_cache(path) == None
+    assert load_surface_cache(str(tmp_path / 'missing.npy')) == None